@@ -0,0 +1,10 @@
+"""
+Benchmarks of the messenger.
+
+    workload        Synthetic workload timing every messenger operation on a throwaway data directory.
+                    Run it with: python3 -m benchmarks.workload [OPTION] ...
+    codec_bench     Micro-benchmark of the data file codecs.
+                    Run it with: python3 -m benchmarks.codec_bench [OPTION] ...
+    parse_bench     Micro-benchmark of the command line parser.
+                    Run it with: python3 -m benchmarks.parse_bench [OPTION] ...
+"""
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the data file codecs of the messenger.
+
+Encodes and decodes data shaped like the files of a data directory (password entries, groups,
+user files) and like mailboxes of growing size with every codec, and prints the size and the
+dump/load throughput per codec.
+
+Usage: python3 benchmarks/codec_bench.py [--sizes <n>,...] [--repeat <n>] [--json]
+"""
+import getopt
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import messenger  # noqa: E402
+
+WORDS = ["hello", "lunch", "meeting", "today", "tomorrow", "see", "you", "at", "the", "office", "thanks",
+         "project", "deadline", "call", "me", "later", "ok", "great", "news", "weekend"]
+
+def passwords(count):
+    """Return a passes.txt dict with <count> users."""
+    return {"user{}".format(i): [os.urandom(32).hex().encode(), os.urandom(32), "sha256", 100000]
+            for i in range(count)}
+
+def groups(count, members):
+    """Return a groups.txt dict of <count> groups with <members> members each."""
+    return {"group{}".format(i): ["user{}".format(j) for j in range(members)] for i in range(count)}
+
+def user_file(count):
+    """Return a user file of a member of <count> groups."""
+    names = ["group{}".format(i) for i in range(count)]
+    return {"groups": names, "channels": {name: [random.randrange(10 ** 6), random.randrange(10 ** 6)]
+                                          for name in names}}
+
+def mailbox(count):
+    """Return <count> [sender, group, time, body] message records."""
+    stamp = time.time()
+    return [["user{}".format(random.randrange(100)), random.choice([None, None, "group1"]), stamp + i,
+             " ".join(random.choice(WORDS) for _ in range(random.randint(3, 20)))] for i in range(count)]
+
+def best(func, repeat):
+    """Return the shortest of <repeat> run times of a function."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def run(sizes, repeat):
+    """Return a list of the results per data set and codec."""
+    random.seed(1)
+    data = [("passes.txt", sizes[-1], passwords(sizes[-1])),
+            ("groups.txt", 100, groups(100, 50)),
+            ("user file", 1000, user_file(1000))]
+    data.extend(("mailbox", size, mailbox(size)) for size in sizes)
+    results = []
+    for name, size, obj in data:
+        for codec in messenger.CODECS.values():
+            encoded = codec.dumps(obj)
+            assert messenger.decode(encoded) == obj, "{} does not round-trip".format(codec.name)
+            dump = best(lambda: codec.dumps(obj), repeat)
+            load = best(lambda: messenger.decode(encoded), repeat)
+            results.append({"data": name, "items": size, "codec": codec.name, "bytes": len(encoded),
+                            "dump_seconds": dump, "load_seconds": load,
+                            "dump_mb_per_second": len(encoded) / dump / 1e6,
+                            "load_mb_per_second": len(encoded) / load / 1e6})
+    return results
+
+def main():
+    """Parse the options, run the benchmark and print the results."""
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "h", ["help", "sizes=", "repeat=", "json"])
+    except getopt.GetoptError as err:
+        sys.exit(err)
+    sizes = [100, 10000, 100000]
+    repeat = 5
+    as_json = False
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            sys.exit(__doc__)
+        elif opt == "--sizes":
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--json":
+            as_json = True
+    results = run(sizes, repeat)
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<12} {:>8} {:<8} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "data", "items", "codec", "bytes", "dump ms", "load ms", "dump MB/s", "load MB/s"))
+    for result in results:
+        print("{data:<12} {items:>8} {codec:<8} {bytes:>12} {dump:>10.2f} {load:>10.2f} {dump_mb_per_second:>10.1f} "
+              "{load_mb_per_second:>10.1f}".format(dump=result["dump_seconds"] * 1000,
+                                                   load=result["load_seconds"] * 1000, **result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the command line parser of the messenger.
+
+Parses a corpus of commands many times and prints the time per parse for each of them. The
+parse is repeated with parsers holding additional dummy commands to show that its cost does not
+depend on the number of commands.
+
+Usage: python3 benchmarks/parse_bench.py [--repeat <n>] [--extra <n>,...] [--json]
+"""
+import copy
+import getopt
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import messenger  # noqa: E402
+
+CORPUS = ["hello", "quit", "1+2*3", "help", "sync", "say hello world", "login alice", "print messages --last 10",
+          "print groups of alice", "print members of team", "print notes.txt", "create user bob",
+          "create group team alice bob carol", "add members to team: dave, erin", "send to bob: see you at 10:30",
+          "send to group team: lunch today?", "delete member from team: bob", "search lunch today",
+          "import users users.csv", "no such command here"]
+
+def best(func, repeat):
+    """Return the shortest of <repeat> run times of a function."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def parser_with(extra):
+    """Return a copy of the parser of the messenger with <extra> additional dummy commands."""
+    parser = copy.deepcopy(messenger.PARSER)
+    for i in range(extra):
+        parser.add(["command{}".format(i), "sub{}".format(i % 10)], lambda session, args, line: None)
+    return parser
+
+def run(repeat, extras):
+    """Return a list of the results per number of extra commands and corpus line."""
+    results = []
+    loops = 1000
+    for extra in extras:
+        parse = parser_with(extra).parse
+        for line in CORPUS:
+            seconds = best(lambda: [parse(line) for _ in range(loops)], repeat) / loops
+            results.append({"extra_commands": extra, "command": line, "ns_per_parse": seconds * 1e9})
+    return results
+
+def main():
+    """Parse the options, run the benchmark and print the results."""
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "h", ["help", "repeat=", "extra=", "json"])
+    except getopt.GetoptError as err:
+        sys.exit(err)
+    repeat = 5
+    extras = [0, 1000, 100000]
+    as_json = False
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            sys.exit(__doc__)
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--extra":
+            extras = [int(extra) for extra in arg.split(",")]
+        elif opt == "--json":
+            as_json = True
+    results = run(repeat, extras)
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<40}".format("command") + "".join("{:>14}".format("ns +{}".format(extra)) for extra in extras))
+    for i, line in enumerate(CORPUS):
+        row = [result["ns_per_parse"] for result in results[i::len(CORPUS)]]
+        print("{:<40}".format(line) + "".join("{:>14.0f}".format(value) for value in row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Synthetic workload benchmark of the messenger operations.
+
+Builds a throwaway data directory, runs every operation many times on it and reports per operation
+the throughput, the p50/p99 latency and the file I/O it caused. The results can be saved as JSON and
+compared with those of an earlier run.
+
+Usage: python3 -m benchmarks.workload [OPTION] ...
+
+Options:
+    -h, --help                  Print this message.
+    --users <n>                 Number of users (default: 200).
+    --groups <n>                Number of groups (default: 20).
+    --group-size <n>            Number of members per group (default: 10).
+    --messages <n>              Number of direct messages (default: 1000).
+    --group-messages <n>        Number of messages to the groups and to the group of all users each
+                                (default: 200).
+    -b, --backend <backend>     Storage backend: 'pickle' (default) or 'sqlite'.
+    --codec <codec>             Format of the data files: 'pickle' (default), 'json' or 'binary'.
+    --hash-iterations <n>       PBKDF2 iterations of the passwords (default: 1, hashed in process).
+    --seed <n>                  Seed of the random choices (default: 1).
+    -o, --output <file>         Save the results as JSON to <file>.
+    --compare <file>            Compare the results with those saved in <file>.
+"""
+import contextlib
+import getopt
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import messenger  # noqa: E402
+
+class IOCounter:
+    """Counts the files opened, renamed and removed by the process and its read and write calls.
+
+    Opens, renames and removes are counted by an audit hook while the counter is enabled. Read and
+    write calls and bytes come from /proc/self/io where it exists (Linux) and include the threads
+    of the process.
+    """
+
+    FIELDS = ["opens_read", "opens_write", "renames", "removes", "syscr", "syscw", "rchar", "wchar"]
+
+    def __init__(self):
+        self.enabled = False
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if not self.enabled:
+            return
+        if event == "open":
+            mode, flags = args[1], args[2]
+            if mode is not None:
+                writes = any(char in mode for char in "wax+")
+            else:
+                writes = bool(flags & (os.O_WRONLY | os.O_RDWR))
+            self.counts["opens_write" if writes else "opens_read"] += 1
+        elif event == "os.rename":
+            self.counts["renames"] += 1
+        elif event == "os.remove":
+            self.counts["removes"] += 1
+
+    @staticmethod
+    def _proc():
+        try:
+            with open("/proc/self/io") as file:
+                return {key: int(value) for key, value in (line.split(": ") for line in file)}
+        except OSError:
+            return {}
+
+    @contextlib.contextmanager
+    def counting(self):
+        """Count the I/O of the block, adding it to counts."""
+        before = self._proc()
+        self.enabled = True
+        try:
+            yield
+        finally:
+            self.enabled = False
+            after = self._proc()
+            for key in ["syscr", "syscw", "rchar", "wchar"]:
+                if key in before and key in after:
+                    self.counts[key] += after[key] - before[key]
+
+    def take(self):
+        """Return the counts so far and start counting from zero."""
+        counts = self.counts
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        return counts
+
+def percentile(values, percent):
+    """Return the value below which <percent> percent of the sorted values lie."""
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+class Workload:
+    """Runs the operations of the messenger on a throwaway data directory and collects their timings."""
+
+    def __init__(self, config):
+        self.config = config
+        self.counter = IOCounter()
+        self.results = {}
+        self.random = random.Random(config["seed"])
+
+    def measure(self, name, calls):
+        """Run the calls one after another, timing each of them.
+
+        Args:
+            name: Name of the operation in the results.
+            calls: Iterable of functions without arguments, one per operation.
+        """
+        latencies = []
+        for call in calls:
+            with self.counter.counting():
+                start = time.perf_counter()
+                call()
+                latencies.append(time.perf_counter() - start)
+        if not latencies:
+            return
+        io = self.counter.take()
+        total = sum(latencies)
+        latencies.sort()
+        self.results[name] = {"count": len(latencies), "seconds": total,
+                              "ops_per_second": len(latencies) / total if total else None,
+                              "p50_ms": percentile(latencies, 50) * 1000,
+                              "p99_ms": percentile(latencies, 99) * 1000,
+                              "io": io, "io_per_op": {key: value / len(latencies) for key, value in io.items()}}
+
+    def run(self):
+        """Build the data directory, run all operations on it and return the results."""
+        config = self.config
+        directory = tempfile.mkdtemp(prefix="messenger-bench-")
+        messenger.DATA = directory + "/data"
+        os.mkdir(messenger.DATA)
+        messenger.CODEC = config["codec"]
+        messenger.HASH_ITERATIONS = config["hash_iterations"]
+        if config["hash_iterations"] == 1:
+            # Low-cost hash mode: hash in process instead of in the process pool.
+            messenger.HASH_POOL = False
+        messenger.STORE = messenger.open_store(config["backend"])
+        messenger.ANSWERS = itertools.repeat("password")
+        users = ["user{}".format(i) for i in range(config["users"])]
+        groups = ["group{}".format(i) for i in range(config["groups"])]
+        pick = self.random.choice
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                self.measure("create_user", (lambda user=user: messenger.create_user(user) for user in users))
+                self.measure("create_group", (lambda group=group: messenger.create_group(group, [])
+                                              for group in groups))
+                members = {group: self.random.sample(users, min(config["group_size"], len(users)))
+                           for group in groups}
+                self.measure("add_members_to_group", (lambda group=group: messenger.add_members_to_group(
+                    members[group], group) for group in groups))
+                self.measure("send_message (user)", (
+                    lambda: messenger.send_message(pick(users), pick(users), self.text())
+                    for _ in range(config["messages"])))
+                self.measure("send_message (group)", (
+                    lambda group=pick(groups): messenger.send_message(pick(members[group]), group, self.text())
+                    for _ in range(config["group_messages"] if groups else 0)))
+                self.measure("send_message (all users)", (
+                    lambda: messenger.send_message(pick(users), "all", self.text())
+                    for _ in range(config["group_messages"])))
+                self.measure("print_new_messages", (lambda user=user: messenger.print_new_messages(user)
+                                                    for user in users))
+                self.measure("delete_group", (lambda group=group: messenger.delete_group(group, members[group][0])
+                                              for group in groups if members[group]))
+                self.measure("delete_user", (lambda user=user: messenger.delete_user(user) for user in users))
+        finally:
+            messenger.STORE.close()
+            if messenger.HASH_POOL:
+                messenger.HASH_POOL.shutdown()
+            messenger.ANSWERS = None
+            shutil.rmtree(directory, ignore_errors=True)
+        return {"config": config, "python": platform.python_version(), "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": self.results}
+
+    def text(self):
+        """Return the text of a random message."""
+        words = ["hello", "lunch", "meeting", "today", "see", "you", "at", "the", "office", "thanks"]
+        return " ".join(self.random.choice(words) for _ in range(self.random.randint(3, 20)))
+
+def print_results(report, baseline=None):
+    """Print the results of a run as a table, with the change of ops/s to a baseline if given."""
+    header = "{:<26} {:>7} {:>10} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+        "operation", "count", "ops/s", "p50 ms", "p99 ms", "opens", "renames", "writes")
+    if baseline is not None:
+        header += " {:>10} {:>8}".format("base ops/s", "change")
+    print(header)
+    for name, result in report["results"].items():
+        io = result["io_per_op"]
+        line = "{:<26} {:>7} {:>10.1f} {:>9.3f} {:>9.3f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+            name, result["count"], result["ops_per_second"] or 0, result["p50_ms"], result["p99_ms"],
+            io["opens_read"] + io["opens_write"], io["renames"], io["syscw"])
+        if baseline is not None:
+            base = baseline["results"].get(name)
+            if base and base["ops_per_second"] and result["ops_per_second"]:
+                change = result["ops_per_second"] / base["ops_per_second"] - 1
+                line += " {:>10.1f} {:>+7.1f}%".format(base["ops_per_second"], change * 100)
+            else:
+                line += " {:>10} {:>8}".format("-", "-")
+        print(line)
+
+def main():
+    """Parse the options, run the workload and print and save the results."""
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hb:o:", ["help", "users=", "groups=", "group-size=", "messages=",
+                                                        "group-messages=", "backend=", "codec=",
+                                                        "hash-iterations=", "seed=", "output=", "compare="])
+    except getopt.GetoptError as err:
+        sys.exit(err)
+    config = {"users": 200, "groups": 20, "group_size": 10, "messages": 1000, "group_messages": 200,
+              "backend": "pickle", "codec": "pickle", "hash_iterations": 1, "seed": 1}
+    numbers = {"--users": "users", "--groups": "groups", "--group-size": "group_size", "--messages": "messages",
+               "--group-messages": "group_messages", "--hash-iterations": "hash_iterations", "--seed": "seed"}
+    output = None
+    baseline = None
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            sys.exit(__doc__)
+        elif opt in numbers:
+            if not arg.isdigit():
+                sys.exit("{}: {} must be a number.".format(arg, opt))
+            config[numbers[opt]] = int(arg)
+        elif opt in ["-b", "--backend"]:
+            if arg not in ["pickle", "sqlite"]:
+                sys.exit("{}: Unknown backend. Choose 'pickle' or 'sqlite'.".format(arg))
+            config["backend"] = arg
+        elif opt == "--codec":
+            if arg not in messenger.CODECS:
+                sys.exit("{}: Unknown codec. Choose one of {}.".format(arg, ", ".join(messenger.CODECS)))
+            config["codec"] = arg
+        elif opt in ["-o", "--output"]:
+            output = arg
+        elif opt == "--compare":
+            try:
+                with open(arg) as file:
+                    baseline = json.load(file)
+            except (OSError, ValueError) as err:
+                sys.exit("{}: {}".format(arg, err))
+    if config["hash_iterations"] < 1:
+        sys.exit("The number of hash iterations must be positive.")
+    report = Workload(config).run()
+    print_results(report, baseline)
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -3,24 +3,67 @@
 Messenger app. Create users and groups and communicate with each other. Also several other functions
 such as printing files and computing expressions have been implemented.
 
-Usage: ./messenger [OPTION] ...
+Usage: ./messenger [OPTION] ... [<user>]
 
 Options:
     -h, --help                              Print this message.
+    -b, --backend <backend>                 Storage backend: 'pickle' (default, data directory) or 'sqlite'.
+    --migrate                               Import the data directory into the SQLite database and exit.
+    -f, --file <script>                     Run the commands of <script> ('-' for stdin) without prompts and
+                                            print a JSON result per command. Used for piped input as well.
+                                            Passwords and [y/n] answers go on 'answer: <text>' lines after
+                                            the command.
+                                            A command raising an error stops the run and drops the changes
+                                            since the last checkpoint.
+    --checkpoint <n>                        In batch mode, write changes every <n> commands (default: at the end).
+    --hash-iterations <n>                   PBKDF2 iterations for new passwords (default: 100000). Existing
+                                            passwords are rehashed on the next login.
+    --serve <address>                       Run a server for many clients on <host>:<port> or a Unix socket path.
+                                            New messages are pushed to logged in clients immediately.
+    --connect <address>                     Connect to a server and use its command line.
+    --watch                                 Print new messages as they arrive instead of only on 'sync',
+                                            also while typing a command.
+    --max-messages <n>                      Keep at most <n> messages in a mailbox when it is compacted
+                                            (default: 1000).
+    --max-age <age>                         Archive read messages older than <age> (e.g. 90d) when a mailbox
+                                            is compacted (default: 365d).
+    --archive-codec <codec>                 Compress archives with 'lzma' (default) or 'zlib'.
+    --ticket-ttl <age>                      Time a login stays valid without a password (default: 30m).
+    --codec <codec>                         Format of the data files: 'pickle' (protocol 5), 'json' (JSON lines)
+                                            or 'binary' (length-prefixed). The format is recorded in the data
+                                            directory and used by default, 'pickle' for a new one. Another
+                                            format can only be chosen with --convert.
+    --convert                               Rewrite all data files in the format of --codec and exit.
+    --compact                               Compact the mailboxes of all users and exit.
+    --reindex                               Rebuild the search index of all messages and exit.
+    --calc <file>                           Print the results of the expressions in <file> ('-' for stdin), one
+                                            per line, and exit. Expressions of the same shape are evaluated
+                                            together with NumPy if it is installed.
+    --profile <file>                        Profile the commands and write the statistics (see 'stats') with
+                                            their latency histograms and the cProfile results to <file> on
+                                            exit. A <file> ending in .prom gets the statistics in the
+                                            Prometheus text format instead, without profiling.
 
 Commands:
     help                                    Print this message.
     Hello, Hi, Greet, Greetings             Greet the program and be greeted back (by name if logged in).
-    x+a*y                                   With x,y,a being numbers. Prints out the result.
+    (x+a)*-y/b                              With x,y,a,b being numbers. Prints out the result of the expression
+                                            of numbers, '+', '-', '*', '/' and parentheses.
     say <output>                            Print out <output>.
     create
         - user <user>                       Create a new user with name <user>.
         - group <group> [<member1>,...]     Create a new group with name <group> and optionally <member1>,...
     add members to <group>: <member1>,...   Add the users <member1>,... to the group <group>.
+    import users <file>                     Create users and group memberships from a CSV or JSON lines file
+                                            (fields: name, password or hash and salt, groups).
     login <user>                            Login as user <user>.
     logout                                  Logout current user.
     print
-        - <file>                            Print out the file <file>.
+        - <file> [--head <n>] [--tail <n>]  Print out the file <file>, optionally only its first or last <n>
+          [--page]                          lines. With --page, a page is printed at a time.
+        - messages [--last <n>]             Print out your messages, optionally only the last <n>, those from
+          [--from <user>] [--since <time>]  <user> or those sent since <time> (ISO date or age like 2h or 7d).
+          [--archive]                       With --archive, the archived messages are searched as well.
         - users                             Print out all users.
         - groups                            Print out all groups.
         - groups of <user>                  Print out all groups of the user <user>.
@@ -28,7 +71,14 @@ Commands:
     send to
         - <user>: <message>                 Send <message> to the user <user>.
         - <group>: <message>                Send <message> to the group <group>.
+        - group <group>: <message>          Send <message> to the group <group> even if a user <group> exists.
     sync                                    Synchronize messages. Print out messages received after login.
+    search <term1> ...                      Print out your messages containing all of the terms, archived
+                                            ones included.
+    stats                                   Print the counters and timings of this process: opened data files,
+                                            encoded bytes and the time spent per command and storage operation.
+    compact                                 Move your old read messages to a compressed archive, keeping
+                                            the mailbox within --max-messages and --max-age.
     delete
         - user <user>                       Delete the user <user>.
         - group <group>                     Delete the group <group>.
@@ -37,745 +87,4748 @@ Commands:
 To quit the program type one of the following commands:
 'stop', 'quit', 'cancel', 'q', 'end', ':q', 'exit'.
 """
+import asyncio
+import atexit
+import base64
 import binascii
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import csv
+import datetime
+import functools
 import getopt
 import getpass
+import gzip
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import lzma
+import mmap
+import multiprocessing
+import operator
 import pickle
+import pstats
+import queue
+import re
+import select
+import shutil
+import socket
+import sqlite3
+import stat
+import struct
 import sys
+import threading
 import time
 import os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import readline
+except ImportError:
+    readline = None
 
 # Global Variables
 
 PATH = os.getcwd()
 DATA = PATH + "/data"
+MAILBOX_HEADER = '{{"mailbox": 4, "read": {:<20d}, "archived": {:<20d}}}\n'
+MAILBOX_HEADER_SIZE = len(MAILBOX_HEADER.format(0, 0))
+MAILBOX_READ_AT = len('{"mailbox": 4, "read": ')
+CHANNEL_HEADER = '{"mailbox": 1}\n'
+WRITE_WORKERS = 8
+INDEX_TTL = 1.0
+READ_BLOCK = 65536
+MAX_MESSAGES = 1000
+MAX_AGE = 365 * 86400
+ARCHIVE_CODEC = "lzma"
+ARCHIVE_CODECS = {"lzma": ("xz", lzma), "zlib": ("gz", gzip)}
+TICKET_TTL = 1800
+CODEC = "pickle"
+CONVERTING = False
+CODEC_FILE = ".codec"
+QUITS = ["stop", "quit", "cancel", "q", "end", ":q", "exit"]
+GREETS = ["hello", "hi", "greet", "greetings"]
+ANSWERS = None
+ANSWER_PREFIX = "answer:"
+HASH_ALGORITHM = "sha256"
+HASH_ITERATIONS = 100000
+HASH_WORKERS = None
+HASH_POOL = None
+SERVER_WORKERS = 32
+SERVER_OUTPUT_LIMIT = 4 * 1024 * 1024
+LISTENERS = []
+LOCAL = threading.local()
+BACKEND = "pickle"
+PROFILE = None
+EXPRESSION_CACHE = 1024
+WATCH_POLL_MIN = 0.05
+WATCH_POLL_MAX = 1.0
+SEARCH_DELTA = 10000
+EXPRESSION_TOKEN = re.compile(r"\s*(?:((?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|([-+*/()]))")
+
+class Stats:
+    """Counters and latency histograms of the hot paths of this process.
+
+    Counters count e.g. the opened data files and the encoded and decoded bytes. Timings record
+    the wall time of the commands and of the storage reads and commits in histograms with the
+    buckets of BUCKETS, labeled by the command or storage operation. All methods are thread-safe.
+    """
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0)
+    LABELS = {"command": "command", "store": "operation"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def add(self, name, amount=1):
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, metric, label, seconds):
+        """Record a duration in the histogram of a metric and label, e.g. ("command", "send")."""
+        with self._lock:
+            entry = self.timings.get((metric, label))
+            if entry is None:
+                entry = self.timings[(metric, label)] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0.0]
+            entry[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    @contextlib.contextmanager
+    def timing(self, metric, label):
+        """Record the wall time of the block, see observe."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, label, time.perf_counter() - start)
+
+    def quantile(self, buckets, fraction):
+        """Return the upper bound of the bucket holding the given fraction of the durations."""
+        rank = fraction * sum(buckets)
+        seen = 0
+        for bound, count in zip(self.BUCKETS, buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def report(self):
+        """Return the counters and timings as a table."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted((key, copy.deepcopy(entry)) for key, entry in self.timings.items())
+        lines = ["Counters:"]
+        lines.extend("    {:<28} {:>12}".format(name, value) for name, value in counters)
+        lines.append("Timings:{:>36} {:>11} {:>10} {:>10} {:>10}".format(
+            "count", "total ms", "mean ms", "p99 ms", "max ms"))
+        for (metric, label), (buckets, total, longest) in timings:
+            count = sum(buckets)
+            lines.append("    {:<28} {:>12} {:>11.3f} {:>10.3f} {:>10} {:>10.3f}".format(
+                "{} {}".format(metric, label), count, total * 1000, total / count * 1000,
+                "<= {:g}".format(self.quantile(buckets, 0.99) * 1000), longest * 1000))
+        return "\n".join(lines) + "\n"
+
+    def prometheus(self):
+        """Return the counters and timings in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted((key, copy.deepcopy(entry)) for key, entry in self.timings.items())
+        lines = []
+        for name, value in counters:
+            lines.append("# TYPE messenger_{}_total counter".format(name))
+            lines.append("messenger_{}_total {}".format(name, value))
+        for metric in sorted({metric for (metric, _), _ in timings}):
+            name = "messenger_{}_seconds".format(metric)
+            lines.append("# TYPE {} histogram".format(name))
+            for (other, label), (buckets, total, _) in timings:
+                if other != metric:
+                    continue
+                label = '{}="{}"'.format(self.LABELS[metric], label.replace("\\", "\\\\").replace('"', '\\"'))
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), buckets):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(name, label, total))
+                lines.append("{}_count{{{}}} {}".format(name, label, cumulative))
+        return "\n".join(lines) + "\n"
+
+STATS = Stats()
+
+class Message:
+    """A message with its sender, recipient, group and time.
+
+    Direct messages have no group. Group messages keep their group, also when they are copied to
+    the mailbox of a member who leaves the group.
+
+    Attributes:
+        seq: Position of the message in its mailbox or channel: the offset behind its record, or
+            its id in the SQLite backend. Increases with every message.
+        sender: Name of the user who sent the message.
+        recipient: Name of the user who received the message.
+        group: Name of the group the message was sent to or None.
+        time: Time the message was sent at.
+        body: Text of the message.
+    """
+
+    __slots__ = ("seq", "sender", "recipient", "group", "time", "body")
+
+    def __init__(self, sender, recipient, body, stamp=None, group=None, seq=0):
+        self.seq = seq
+        self.sender = sender
+        self.recipient = recipient
+        self.group = group
+        self.time = time.time() if stamp is None else stamp
+        self.body = body
+
+    def __str__(self):
+        if self.group is not None:
+            return "From {}: {} (sent to {})".format(self.sender, self.body, self.group)
+        return "From {}: {}".format(self.sender, self.body)
+
+    def __repr__(self):
+        return "Message({!r}, {!r}, {!r}, {!r}, {!r}, {!r})".format(
+            self.sender, self.recipient, self.body, self.time, self.group, self.seq)
+
+    def record(self):
+        """Return the [sender, group, time, body] record the message is stored as."""
+        return [self.sender, self.group, self.time, self.body]
+
+    @classmethod
+    def from_record(cls, record, recipient, seq=0):
+        """Create a message from a stored record, also from an old [text, time] one."""
+        if len(record) == 2:
+            return cls.parse(record[0], recipient, record[1], seq)
+        sender, group, stamp, body = record
+        return cls(sender, recipient, body, stamp, group, seq)
+
+    @classmethod
+    def parse(cls, text, recipient, stamp=0, seq=0):
+        """Create a message from the old text form "From <sender>: <body>[ (sent to <group>)]"."""
+        match = re.fullmatch(r"From ([^:]*): (.*?)(?: \(sent to ([^()]+)\))?", text, re.S)
+        if match is None:
+            return cls("", recipient, text, stamp, seq=seq)
+        sender, body, group = match.groups()
+        return cls(sender, recipient, body, stamp, group, seq)
+
+def index_terms(text):
+    """Return the sorted search terms of a text: its distinct words in lower case."""
+    return sorted(set(re.findall(r"\w+", text.lower())))
+
+class PickleCodec:
+    """Pickle protocol 5. Fastest, but loading it runs code, so only use it for trusted data."""
+
+    name = "pickle"
+    magic = b"\x80"
+
+    @staticmethod
+    def dumps(obj):
+        return pickle.dumps(obj, protocol=5)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+class JSONCodec:
+    """JSON lines: a header line with the type, then one line per item of a dict or list.
+
+    Bytes are written as {"$bytes": <base64>}, tuples are read back as lists.
+    """
+
+    name = "json"
+    magic = b"#json "
+
+    @classmethod
+    def dumps(cls, obj):
+        if isinstance(obj, dict):
+            kind, items = "dict", obj.items()
+        elif isinstance(obj, (list, tuple)):
+            kind, items = "list", obj
+        else:
+            kind, items = "value", [obj]
+        lines = [json.dumps(item, default=cls._encode) + "\n" for item in items]
+        return cls.magic + (kind + "\n" + "".join(lines)).encode()
+
+    @classmethod
+    def loads(cls, data):
+        lines = data.decode().splitlines()
+        kind = lines[0][len(cls.magic):]
+        items = [json.loads(line, object_hook=cls._decode) for line in lines[1:]]
+        if kind == "dict":
+            return {key: value for key, value in items}
+        if kind == "list":
+            return items
+        return items[0]
+
+    @staticmethod
+    def _encode(obj):
+        if isinstance(obj, bytes):
+            return {"$bytes": base64.b64encode(obj).decode()}
+        raise TypeError("{} cannot be written as JSON".format(type(obj).__name__))
+
+    @staticmethod
+    def _decode(obj):
+        if len(obj) == 1 and "$bytes" in obj:
+            return base64.b64decode(obj["$bytes"])
+        return obj
+
+class BinaryCodec:
+    """Compact binary format of type tagged values with struct packed, length-prefixed payloads.
+
+    None, bool, int (64 bit), float, str, bytes, list, tuple and dict are supported.
+    """
+
+    name = "binary"
+    magic = b"MSB1"
+
+    @classmethod
+    def dumps(cls, obj):
+        parts = [cls.magic]
+        cls._pack(obj, parts)
+        return b"".join(parts)
+
+    @classmethod
+    def _pack(cls, obj, parts):
+        if obj is None:
+            parts.append(b"N")
+        elif obj is True or obj is False:
+            parts.append(b"T" if obj else b"F")
+        elif isinstance(obj, int):
+            parts.append(struct.pack("<cq", b"i", obj))
+        elif isinstance(obj, float):
+            parts.append(struct.pack("<cd", b"d", obj))
+        elif isinstance(obj, (str, bytes)):
+            data = obj.encode() if isinstance(obj, str) else obj
+            parts.append(struct.pack("<cI", b"s" if isinstance(obj, str) else b"b", len(data)))
+            parts.append(data)
+        elif isinstance(obj, (list, tuple)):
+            parts.append(struct.pack("<cI", b"l" if isinstance(obj, list) else b"t", len(obj)))
+            for item in obj:
+                cls._pack(item, parts)
+        elif isinstance(obj, dict):
+            parts.append(struct.pack("<cI", b"m", len(obj)))
+            for key, value in obj.items():
+                cls._pack(key, parts)
+                cls._pack(value, parts)
+        else:
+            raise TypeError("{} cannot be written in the binary format".format(type(obj).__name__))
+
+    @classmethod
+    def loads(cls, data):
+        return cls._unpack(memoryview(data), len(cls.magic))[0]
+
+    @classmethod
+    def _unpack(cls, data, offset):
+        """Return the value at an offset and the offset behind it."""
+        tag = data[offset:offset + 1].tobytes()
+        offset += 1
+        if tag == b"N":
+            return None, offset
+        if tag in (b"T", b"F"):
+            return tag == b"T", offset
+        if tag == b"i":
+            return struct.unpack_from("<q", data, offset)[0], offset + 8
+        if tag == b"d":
+            return struct.unpack_from("<d", data, offset)[0], offset + 8
+        size = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        if tag == b"s":
+            return str(data[offset:offset + size], "utf-8"), offset + size
+        if tag == b"b":
+            return data[offset:offset + size].tobytes(), offset + size
+        items = []
+        for _ in range(size * 2 if tag == b"m" else size):
+            item, offset = cls._unpack(data, offset)
+            items.append(item)
+        if tag == b"m":
+            return dict(zip(items[::2], items[1::2])), offset
+        return (items if tag == b"l" else tuple(items)), offset
+
+CODECS = {codec.name: codec for codec in (PickleCodec, JSONCodec, BinaryCodec)}
+
+def encode(obj):
+    """Return the bytes of an object in the format of CODEC."""
+    data = CODECS[CODEC].dumps(obj)
+    STATS.add("encoded_bytes", len(data))
+    return data
+
+def decode(data):
+    """Return the object of bytes written by encode, recognizing the format by its first bytes.
+
+    Loading pickled data runs code, so it is refused unless CODEC is pickle or the data is being
+    converted (CONVERTING).
+
+    Raises:
+        ValueError: If the data is pickled and pickle is not allowed.
+    """
+    STATS.add("decoded_bytes", len(data))
+    for codec in (JSONCodec, BinaryCodec):
+        if data.startswith(codec.magic):
+            return codec.loads(data)
+    if CODEC != PickleCodec.name and not CONVERTING:
+        raise ValueError("Refusing to load pickled data with the {} codec. Convert it with --convert.".format(CODEC))
+    return PickleCodec.loads(data)
+
+class BaseStore:
+    """Common transaction handling of the storage backends."""
+
+    def __init__(self):
+        self._depth = 0
+
+    def commit(self):
+        """Persist all changes unless inside a batch."""
+        raise NotImplementedError
+
+    def rollback(self):
+        """Drop all changes that have not been committed yet."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the store."""
+
+    def remove(self):
+        """Close the store and remove its files from the data directory, leaving those of other backends."""
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer commits until the end of the block. Changes are dropped if the block raises."""
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                self.rollback()
+            raise
+        self._depth -= 1
+        self.commit()
+
+class DataStore(BaseStore):
+    """In-process cache of the encoded files in the data directory.
+
+    Every file is decoded at most once and kept in memory until its modification time or size
+    changes on disk. Changes are kept in memory and written back to disk on commit(), encoded in
+    the format of CODEC. Files in the other formats are still read, pickled ones only if CODEC
+    is pickle or while converting, see decode.
+
+    Messages live in an append-only mailbox per user (<user>.box): a fixed size header line
+    holding the offset up to which the messages have been read and the number of archived
+    messages, followed by one JSON encoded [sender, group, time, body] record per line. Delivering
+    a message is a single append and marking messages as read rewrites only the read offset.
+    Compacting a mailbox moves its oldest read records to compressed archive segments
+    (<user>.box.<first>-<end>.xz or .gz), which are only read on demand.
+
+    Group messages are stored once in a channel per group (<group>.chan) of the same records.
+    Channels may still hold [text, time] records of earlier versions, which are parsed on reading.
+    Every member keeps [joined, read] byte offsets into the channels of its groups in its user
+    file.
+
+    The names of all users are kept in users.idx, one per line, and held as a set in memory so
+    existence checks neither unpickle user files nor touch the disk. The index is re-read if it
+    changed on disk, checking at most every INDEX_TTL seconds.
+
+    Several processes may share the data directory. Every file is written under an exclusive
+    fcntl lock of its own, so writers of different files do not wait for each other. Pickled
+    files are replaced atomically by writing a temporary file and renaming it. The changes are
+    kept as functions and applied again to the current content of a file if another process
+    changed it since it was read, so concurrent changes are not lost.
+
+    Every mailbox and channel has a search index in .search/<file>.terms with one JSON line
+    [time, terms, offset] per record, archived ones included, so the n-th line belongs to the n-th
+    record. The offset is where the record starts in the file, null for archived records. The
+    index is appended to together with its file, rewritten when the mailbox is compacted, and
+    inverted into term -> record numbers by a TermIndex, which keeps a snapshot of it in
+    .search/<file>.post. A search then seeks to the matching records. A missing or outdated index
+    is rebuilt from the records on the next search.
+
+    Login tickets are held by a SessionStore and persisted in the append-only .tickets.log.
+
+    A commit that changes more than one file first writes all of its changes to a journal
+    (.journal-<pid>-<thread>), which is removed once they have been written. The journals left
+    behind by an interrupted commit are completed on the next access of the data directory, so
+    a commit is either applied as a whole or not at all.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._index = None
+        self._index_stamp = None
+        self._index_checked = 0
+        self._index_dirty = False
+        self._index_changes = []
+        self._cache = {}
+        self._changes = {}
+        self._box_appends = {}
+        self._box_sizes = {}
+        self._box_read = {}
+        self._checked = set()
+        self._pool = None
+        self._recovered = None
+        self._search = {}
+        self._sessions = SessionStore()
+        self._sessions_checked = None
+
+    def _path(self, name):
+        if self._recovered != DATA:
+            self._recover()
+        return '{}/{}'.format(DATA, name)
+
+    @staticmethod
+    def _stamp(path):
+        """Return the (inode, modification time, size) of a file or None if it does not exist."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locked(path, wait=True):
+        """Hold an exclusive lock on a data file while the block is executed.
+
+        The lock is taken on an empty file of the same name in the .locks directory, so it stays
+        valid when the data file is replaced. Without fcntl (e.g. on Windows) nothing is locked.
+
+        Args:
+            path: Path of the data file.
+            wait: Wait for the lock. Otherwise BlockingIOError is raised if it is held elsewhere.
+        """
+        if fcntl is None:
+            yield
+            return
+        directory = os.path.join(os.path.dirname(path), '.locks')
+        os.makedirs(directory, exist_ok=True)
+        STATS.add("locks")
+        with open(os.path.join(directory, os.path.basename(path)), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            yield
+
+    @staticmethod
+    def _open(path, mode='r'):
+        """Open a data file, counting it in STATS."""
+        STATS.add("file_opens")
+        return open(path, mode)
+
+    @classmethod
+    def _write(cls, path, data):
+        """Replace a file atomically with the given bytes by renaming a temporary file."""
+        with cls._replacing(path) as file:
+            file.write(data)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _replacing(path, opener=open):
+        """Replace a file atomically with what is written to the yielded file, see _write.
+
+        Args:
+            path: Path of the file to replace.
+            opener: Function opening the temporary file, e.g. lzma.open to compress it.
+        """
+        temp = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        STATS.add("file_opens")
+        with opener(temp, 'wb') as file:
+            yield file
+        os.replace(temp, path)
+
+    def _load(self, name, default=None):
+        """Return the content of a data file, re-reading it only if it changed on disk.
+
+        Args:
+            name: Name of the file relative to the data directory.
+            default: Value to return if the file does not exist.
+        """
+        path = self._path(name)
+        if path in self._changes:
+            obj = self._cache[path][1]
+            return default if obj is None else obj
+        stamp = self._stamp(path)
+        if stamp is None:
+            self._cache.pop(path, None)
+            return default
+        entry = self._cache.get(path)
+        if entry is None or entry[0] != stamp:
+            with STATS.timing("store", "load"), self._open(path, 'rb') as file:
+                entry = [stamp, decode(file.read())]
+            self._cache[path] = entry
+        return entry[1]
+
+    def _store(self, name, obj):
+        """Replace the content of a data file. The change is written on the next commit.
+
+        Args:
+            name: Name of the file relative to the data directory.
+            obj: New content of the file, None to remove the file.
+        """
+        path = self._path(name)
+        self._cache[path] = [None, obj]
+        self._changes[path] = (None, None)
+
+    def _update(self, name, change, default=None):
+        """Change the content of an encoded data file. The change is written on the next commit.
+
+        Args:
+            name: Name of the file relative to the data directory.
+            change: Function taking the content of the file and returning its new content, None
+                to remove the file. It is applied again to the content on disk if another
+                process changed the file before the commit.
+            default: Content of the file if it does not exist.
+        """
+        path = self._path(name)
+        obj = self._load(name, copy.deepcopy(default))
+        if path not in self._cache:
+            self._cache[path] = [None, obj]
+        if path not in self._changes:
+            self._changes[path] = (default, [])
+        self._cache[path][1] = change(obj)
+        changes = self._changes[path][1]
+        if changes is not None:
+            changes.append(change)
+
+    def _set_item(self, name, key, value):
+        """Set an entry of an encoded dict, e.g. the password entry of a user in passes.txt."""
+        def change(obj):
+            obj[key] = value
+            return obj
+        self._update(name, change, {})
+
+    def _pop_item(self, name, key):
+        """Remove an entry of an encoded dict if it exists."""
+        def change(obj):
+            obj.pop(key, None)
+            return obj
+        self._update(name, change, {})
+
+    def exists(self, name):
+        """Return True if the data file exists on disk or is about to be written."""
+        return self._load(name) is not None
+
+    def commit(self):
+        """Write all changed files back to disk unless inside a batch.
+
+        Pending mailbox appends are written in parallel on a thread pool.
+
+        Returns:
+            List of the mailbox files whose records could not be appended.
+        """
+        if self._depth:
+            return []
+        changed = len(self._changes) + self._index_dirty + bool(self._sessions.pending)
+        if not changed + len(self._box_appends) + len(self._box_read):
+            return []
+        with STATS.timing("store", "commit"), contextlib.ExitStack() as locks:
+            contents = self._final_contents(locks)
+            if changed + len(self._box_appends) + len(self._box_read) < 2:
+                return self._write_changes(contents, locks)
+            journal = '{}/.journal-{}-{}'.format(DATA, os.getpid(), threading.get_ident())
+            with self._locked(journal):
+                self._write(journal, encode(self._journal_entries(contents)))
+                failed = self._write_changes(contents, locks)
+                os.remove(journal)
+                rm_file(os.path.join(DATA, '.locks', os.path.basename(journal)))
+            return failed
+
+    def _final_contents(self, locks):
+        """Lock the files to be replaced in the order of their paths and return their new content.
+
+        The changes of a file that another process changed since it was read are applied again to
+        its current content, so the journal and the file are written from the same content.
+
+        Args:
+            locks: ExitStack holding the locks until the files have been written.
+
+        Returns:
+            Dict of the paths and their (object, encoded content or None to remove the file).
+        """
+        index = self._path('users.idx') if self._index_dirty else None
+        contents = {}
+        for path in sorted(set(self._changes) | ({index} if index else set())):
+            locks.enter_context(self._locked(path))
+            if path == index:
+                stamp = self._stamp(path)
+                if stamp is not None and stamp != self._index_stamp:
+                    with self._open(path) as file:
+                        names = set(file.read().split())
+                    for name, exists in self._index_changes:
+                        if exists:
+                            names.add(name)
+                        else:
+                            names.discard(name)
+                    self._index = (path, names)
+                contents[path] = (None, "".join(name + "\n" for name in sorted(self._index[1])).encode())
+                continue
+            default, changes = self._changes[path]
+            stamp, obj = self._cache[path]
+            if changes is not None and self._stamp(path) != stamp:
+                # Changed by another process since it was read: redo the changes on its content.
+                try:
+                    with self._open(path, 'rb') as file:
+                        obj = decode(file.read())
+                except FileNotFoundError:
+                    obj = copy.deepcopy(default)
+                for change in changes:
+                    obj = change(obj)
+            contents[path] = (obj, None if obj is None else encode(obj))
+        return contents
+
+    def _journal_entries(self, contents):
+        """Return the pending changes as a list of entries for the journal, see _redo.
+
+        Args:
+            contents: New content of the files to be replaced, see _final_contents.
+        """
+        entries = [("replace", path, data) for path, (_, data) in sorted(contents.items())]
+        if self._sessions.pending:
+            entries.append(("append", self._path('.tickets.log'), self._sessions.lines()))
+        for path, records in sorted(self._box_appends.items()):
+            data = "".join(json.dumps(record) + "\n" for record in records)
+            entries.append(("append", path, data.encode()))
+        for path, offset in sorted(self._box_read.items()):
+            entries.append(("read", path, offset))
+        return entries
+
+    def _recover(self):
+        """Complete the commits of the journals left behind by interrupted processes.
+
+        A journal is in use as long as its lock is held, so only the journals of processes that
+        are gone are completed.
+        """
+        self._recovered = DATA
+        try:
+            names = sorted(os.listdir(DATA))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.startswith('.journal-'):
+                continue
+            journal = os.path.join(DATA, name)
+            try:
+                with self._locked(journal, wait=False):
+                    with self._open(journal, 'rb') as file:
+                        entries = decode(file.read())
+                    for entry in entries:
+                        self._redo(entry)
+                    os.remove(journal)
+                    rm_file(os.path.join(DATA, '.locks', name))
+            except (BlockingIOError, FileNotFoundError):
+                continue
+        self._cache.clear()
+
+    def _redo(self, entry):
+        """Write a change of a journal again. Appends are only repeated if they are missing.
+
+        Args:
+            entry: ("replace", path, encoded content or None to remove the file),
+                ("append", path, records as JSON lines) or ("read", path, read offset).
+        """
+        kind, path, data = entry
+        with self._locked(path):
+            if kind == "replace":
+                if data is None:
+                    rm_file(path)
+                else:
+                    self._write(path, data)
+            elif kind == "append":
+                with self._open(path, 'a+b') as file:
+                    file.seek(0)
+                    content = file.read()
+                    if data in content:
+                        return
+                    if not content:
+                        file.write(self._header(path).encode())
+                    elif not content.endswith(b"\n"):
+                        partial = content[content.rfind(b"\n") + 1:]
+                        if data.startswith(partial):
+                            data = data[len(partial):]
+                        else:
+                            file.write(b"\n")
+                    file.write(data)
+            elif os.path.exists(path):
+                with self._open(path, 'r+') as file:
+                    file.seek(MAILBOX_READ_AT)
+                    file.write('{:<20d}'.format(data))
+
+    def _write_changes(self, contents, locks):
+        """Write the pending changes. Returns the mailbox files that could not be appended to.
+
+        Args:
+            contents: New content of the files to be replaced, see _final_contents.
+            locks: ExitStack holding the locks of the files to be replaced, released once they
+                have been written, before the appends lock their files.
+        """
+        for path, (obj, data) in sorted(contents.items()):
+            if data is None:
+                rm_file(path)
+                self._cache.pop(path, None)
+            else:
+                self._write(path, data)
+                if path in self._changes:
+                    self._cache[path] = [self._stamp(path), obj]
+        self._changes.clear()
+        if self._index_dirty:
+            self._index_stamp = self._stamp(self._path('users.idx'))
+            self._index_dirty = False
+            self._index_changes.clear()
+        locks.close()
+        if self._sessions.pending:
+            path = self._path('.tickets.log')
+            with self._locked(path):
+                self._sessions.flush(path)
+        appends = sorted(self._box_appends.items())
+        if len(appends) > 1:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(WRITE_WORKERS)
+            results = list(self._pool.map(self._append, appends))
+        else:
+            results = [self._append(item) for item in appends]
+        failed = [path for (path, _), written in zip(appends, results) if not written]
+        for path, offset in sorted(self._box_read.items()):
+            try:
+                with self._locked(path), self._open(path, 'r+') as file:
+                    file.seek(MAILBOX_READ_AT)
+                    file.write('{:<20d}'.format(offset))
+            except FileNotFoundError:
+                continue
+        self._box_appends.clear()
+        self._box_sizes.clear()
+        self._box_read.clear()
+        return failed
+
+    @staticmethod
+    def _header(path, read=None, archived=0):
+        """Return the header line of a new mailbox or channel file, nothing for other logs."""
+        if path.endswith('.box'):
+            return MAILBOX_HEADER.format(MAILBOX_HEADER_SIZE if read is None else read, archived)
+        if path.endswith('.chan'):
+            return CHANNEL_HEADER
+        return ""
+
+    def _append(self, item):
+        """Append records to a mailbox or channel file, creating it if necessary.
+
+        Args:
+            item: Tuple of the path of the file and the list of records to append.
+
+        Returns:
+            True if the records have been written, False otherwise.
+        """
+        path, entries = item
+        lines = [json.dumps(entry) + "\n" for entry in entries]
+        terms = [self._index_entry(entry) for entry in entries]
+        try:
+            with self._locked(path), self._open(path, 'a+b') as file:
+                size = file.tell()
+                if not size:
+                    file.write(self._header(path).encode())
+                else:
+                    file.seek(size - 1)
+                    if file.read(1) != b"\n":
+                        # Terminate the incomplete record of an interrupted append.
+                        file.write(b"\n")
+                        terms.insert(0, [None, [], None])
+                offset = file.tell()
+                for entry, line in zip(terms[len(terms) - len(lines):], lines):
+                    entry.append(offset)
+                    offset += len(line)
+                file.write("".join(lines).encode())
+                self._add_terms(path, terms, not size)
+        except OSError:
+            return False
+        return True
+
+    def _terms_path(self, path):
+        """Return the path of the search index of a mailbox or channel file."""
+        return self._path('.search/{}.terms'.format(os.path.basename(path)))
+
+    @staticmethod
+    def _index_entry(record):
+        """Return the [time, terms] of the search index line for a record, None for a broken one."""
+        if record is None:
+            return [None, []]
+        message = Message.from_record(record, None)
+        return [message.time, index_terms(message.body)]
+
+    def _write_terms(self, index, data):
+        """Write a search index anew, dropping the snapshot of its former content."""
+        self._write(index, data)
+        try:
+            os.remove(TermIndex.snapshot_path(index))
+        except FileNotFoundError:
+            pass
+
+    def _add_terms(self, path, terms, new):
+        """Append lines to the search index of a mailbox or channel while its lock is held.
+
+        Args:
+            path: Path of the mailbox or channel file.
+            terms: [time, terms, offset] lines of the records that have been appended.
+            new: The file has just been created, so a new index is started. Otherwise, a missing
+                index is left to be rebuilt on the next search.
+        """
+        index = self._terms_path(path)
+        data = "".join(json.dumps(entry) + "\n" for entry in terms).encode()
+        if new:
+            os.makedirs(os.path.dirname(index), exist_ok=True)
+            self._write_terms(index, data)
+        elif os.path.exists(index):
+            with self._open(index, 'ab') as file:
+                file.write(data)
+
+    def rollback(self):
+        """Drop all changes that have not been committed yet."""
+        for path in self._changes:
+            self._cache.pop(path, None)
+        self._changes.clear()
+        if self._index_dirty:
+            self._index = None
+            self._index_dirty = False
+            self._index_changes.clear()
+        self._box_appends.clear()
+        self._box_sizes.clear()
+        self._box_read.clear()
+        self._sessions.rollback()
+
+    def close(self):
+        """Shut down the thread pool used for parallel appends."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def remove(self):
+        """Close the store and remove its index, ticket, lock and search files from the data directory."""
+        self.close()
+        for name in ["groups.txt", "passes.txt", ".tickets.txt", ".tickets.log", "users.idx"]:
+            rm_file(DATA + "/" + name)
+        if os.path.isdir(DATA + "/.locks"):
+            for name in os.listdir(DATA + "/.locks"):
+                rm_file(DATA + "/.locks/" + name)
+            os.rmdir(DATA + "/.locks")
+        shutil.rmtree(DATA + "/.search", ignore_errors=True)
+        self._cache.clear()
+        self._index = None
+
+    def users(self):
+        """Return a list of the existing users."""
+        return list(self._load('passes.txt', {}))
+
+    def _user_index(self):
+        """Return the set of user names, re-reading users.idx only if it changed on disk.
+
+        A missing index is rebuilt from passes.txt and the user files.
+        """
+        path = self._path('users.idx')
+        now = time.monotonic()
+        if self._index is not None and self._index[0] == path and (
+                self._index_dirty or now - self._index_checked < INDEX_TTL):
+            return self._index[1]
+        self._index_checked = now
+        stamp = self._stamp(path)
+        if stamp is None:
+            names = {user for user in self.users() if self.exists('{}.txt'.format(user))}
+            self._index = (path, names)
+            self._index_dirty = True
+            self.commit()
+            return names
+        if self._index is None or self._index[0] != path or self._index_stamp != stamp:
+            with self._open(path) as file:
+                self._index = (path, set(file.read().split()))
+            self._index_stamp = stamp
+        return self._index[1]
+
+    def user_exists(self, user):
+        """Return True if the user exists. Answered from the in-memory name index."""
+        return user in self._user_index()
+
+    def password(self, user):
+        """Return the [hash, salt, algorithm, iterations] entry of the user or None."""
+        return self._load('passes.txt', {}).get(user)
+
+    def set_password(self, user, password):
+        """Replace the password entry of the user."""
+        self._set_item('passes.txt', user, password)
+
+    def add_user(self, user, password):
+        """Register a new user with its password entry and an empty user file."""
+        self._set_item('passes.txt', user, password)
+        self._store('{}.txt'.format(user), {"groups": [], "channels": {}})
+        self._user_index().add(user)
+        self._index_changes.append((user, True))
+        self._index_dirty = True
+
+    def remove_user(self, user):
+        """Remove the user with its password entry, user file, mailbox, memberships and ticket.
+
+        The group messages the user received are not copied to its mailbox, as it is removed.
+        """
+        def leave(d_group):
+            for members in d_group.values():
+                if user in members:
+                    members.remove(user)
+            return d_group
+        if self.groups_of(user):
+            self._update('groups.txt', leave, {})
+        self.drop_ticket(user)
+        self._pop_item('passes.txt', user)
+        self._store('{}.txt'.format(user), None)
+        self._user_index().discard(user)
+        self._index_changes.append((user, False))
+        self._index_dirty = True
+        path = self._path('{}.box'.format(user))
+        self._unqueue(path)
+        self._box_read.pop(path, None)
+        self._store('{}.box'.format(user), None)
+        for _, _, name in self._archives(user):
+            self._store(name, None)
+        self._store('.search/{}.box.terms'.format(user), None)
+        self._store('.search/{}.box.post'.format(user), None)
+
+    def _user(self, user):
+        d_user = self._load('{}.txt'.format(user))
+        if d_user is not None:
+            d_user.setdefault("groups", [])
+            d_user.setdefault("channels", {})
+        return d_user
+
+    def _update_user(self, user, change):
+        """Change the user file of a user in place, see _update.
+
+        Args:
+            user: Name of the user.
+            change: Function changing the user's dict in place. It is not called if the user
+                file has been removed.
+        """
+        def update(d_user):
+            if d_user is not None:
+                d_user.setdefault("groups", [])
+                d_user.setdefault("channels", {})
+                change(d_user)
+            return d_user
+        self._update('{}.txt'.format(user), update)
+
+    def _migrate(self, user):
+        """Convert the messages of a user to the current mailbox format.
+
+        Messages of a user file in the old format are moved to a mailbox file, mailboxes with per
+        message "new" flags get a read offset instead, and [text, time] records are split into
+        [sender, group, time, body] records. Mailboxes without a count of archived messages only
+        get the current header.
+
+        Args:
+            user: Name of the user whose messages are to be migrated.
+        """
+        path = self._path('{}.box'.format(user))
+        if path in self._checked:
+            return
+        d_user = self._user(user)
+        entries = None
+        upgrade = False
+        if d_user and "messages" in d_user:
+            entries = d_user["messages"]
+            self._update_user(user, lambda d_user: d_user.pop("messages", None))
+        else:
+            try:
+                with self._open(path) as file:
+                    line = file.readline()
+                    header = json.loads(line)
+                    if header.get("mailbox") == 1:
+                        entries = [json.loads(line) for line in file if line.endswith("\n")]
+                    elif header.get("mailbox") == 2:
+                        entries = []
+                        offset = len(line)
+                        for line in file:
+                            if not line.endswith("\n"):
+                                break
+                            offset += len(line)
+                            text, stamp = json.loads(line)
+                            entries.append([text, int(offset > header["read"]), stamp])
+                    elif header.get("mailbox") == 3:
+                        upgrade = True
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        if upgrade:
+            with self._locked(path), self._open(path, 'rb') as file:
+                line = file.readline()
+                header = json.loads(line)
+                if header.get("mailbox") == 3:
+                    read = header["read"] - len(line) + MAILBOX_HEADER_SIZE
+                    self._write(path, self._header(path, read).encode() + file.read())
+        if entries is not None:
+            records = [Message.parse(entry[0], user, entry[2] if len(entry) > 2 else 0).record() for entry in entries]
+            flags = [entry[1] for entry in entries]
+            unread = flags.index(1) if 1 in flags else len(flags)
+            lines = [json.dumps(record) + "\n" for record in records]
+            read = MAILBOX_HEADER_SIZE + sum(len(line) for line in lines[:unread])
+            with self._locked(path):
+                self._write(path, (self._header(path, read) + "".join(lines)).encode())
+            self.commit()
+        if d_user is not None:
+            self._checked.add(path)
+
+    def groups_of(self, user):
+        """Return a list of the groups of the user."""
+        d_user = self._user(user)
+        return list(d_user["groups"]) if d_user else []
+
+    def messages(self, user):
+        """Return a list of the messages in the user's mailbox."""
+        if not self.user_exists(user):
+            return []
+        self._migrate(user)
+        return self._read_messages(self._path('{}.box'.format(user)), MAILBOX_HEADER_SIZE, user)[0]
+
+    def new_messages(self, user):
+        """Return the unread messages of the user's mailbox.
+
+        Only the records behind the read offset are read.
+
+        Returns:
+            Tuple of the list of messages and the offset behind the last of them.
+        """
+        if not self.user_exists(user):
+            return [], MAILBOX_HEADER_SIZE
+        self._migrate(user)
+        path = self._path('{}.box'.format(user))
+        return self._read_messages(path, self._read_offset(path), user)
+
+    def _read_messages(self, path, offset, user):
+        """Read the messages of a mailbox or channel behind an offset, see _read_log."""
+        entries, offset = self._log_entries(path, offset)
+        return [Message.from_record(record, user, end) for end, record in entries], offset
+
+    def mark_read(self, user, offset):
+        """Set the read offset of the user's mailbox, e.g. to the offset of new_messages."""
+        path = self._path('{}.box'.format(user))
+        if offset != self._read_offset(path):
+            self._box_read[path] = offset
+
+    def _read_offset(self, path):
+        """Return the read offset of a mailbox file."""
+        if path in self._box_read:
+            return self._box_read[path]
+        try:
+            with self._open(path) as file:
+                return json.loads(file.readline())["read"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return MAILBOX_HEADER_SIZE
+
+    def append_message(self, user, message):
+        """Append a new message to the mailbox of the user. Only the new record is written."""
+        self._add_entry(user, message.record())
+
+    def _add_entry(self, user, entry, read=False):
+        """Append a record to the mailbox of the user.
+
+        Args:
+            user: Name of the user whose mailbox is to be appended to.
+            entry: Record of the message to append.
+            read: Mark the record as read if there are no unread messages before it.
+        """
+        self._migrate(user)
+        path = self._path('{}.box'.format(user))
+        if read:
+            end = self._log_end(path)
+            self._queue(path, entry)
+            if self._read_offset(path) == end:
+                self._box_read[path] = self._log_end(path)
+        else:
+            self._queue(path, entry)
+
+    def _queue(self, path, entry):
+        """Add a record to the pending appends of a mailbox or channel, counting their bytes."""
+        self._box_appends.setdefault(path, []).append(entry)
+        self._box_sizes[path] = self._box_sizes.get(path, 0) + len(json.dumps(entry)) + 1
+
+    def _unqueue(self, path):
+        """Drop the pending appends of a mailbox or channel."""
+        self._box_appends.pop(path, None)
+        self._box_sizes.pop(path, None)
+
+    def compact(self, user, max_messages=None, max_age=None):
+        """Move the oldest read messages of the user's mailbox to a compressed archive segment.
+
+        Messages are archived as long as the mailbox holds more than max_messages of them or they
+        are older than max_age, unread messages are kept. The segment is written before the
+        mailbox is replaced, and only the segments within the count of archived messages in the
+        mailbox header are read, so the segment of an interrupted compaction is ignored.
+
+        Args:
+            user: Name of the user whose mailbox is to be compacted.
+            max_messages: Number of messages to keep, None for no limit.
+            max_age: Age in seconds from which on read messages are archived, None for no limit.
+
+        Returns:
+            Number of archived messages.
+        """
+        if not self.user_exists(user):
+            return 0
+        self._migrate(user)
+        path = self._path('{}.box'.format(user))
+        read = self._read_offset(path)
+        cutoff = None if max_age is None else time.time() - max_age
+        with self._locked(path):
+            try:
+                file = self._open(path, 'rb')
+            except FileNotFoundError:
+                return 0
+            with file:
+                header = json.loads(file.readline())
+                count = old = 0
+                ends = []
+                offset = MAILBOX_HEADER_SIZE
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    count += 1
+                    if offset <= read:
+                        ends.append(offset)
+                        if cutoff is not None and old == len(ends) - 1:
+                            try:
+                                old += Message.from_record(json.loads(line), user).time < cutoff
+                            except ValueError:
+                                # Incomplete record of an interrupted append, archived with the others.
+                                old += 1
+                archive = min(len(ends), max(old, 0 if max_messages is None else count - max_messages))
+                if archive <= 0:
+                    return 0
+                end = ends[archive - 1]
+                first = header["archived"]
+                extension, module = ARCHIVE_CODECS[ARCHIVE_CODEC]
+                name = '{}.box.{}-{}.{}'.format(user, first, first + archive, extension)
+                file.seek(MAILBOX_HEADER_SIZE)
+                with self._replacing(self._path(name), module.open) as segment:
+                    size = end - MAILBOX_HEADER_SIZE
+                    while size:
+                        data = file.read(min(size, READ_BLOCK))
+                        segment.write(data)
+                        size -= len(data)
+                with self._replacing(path) as box:
+                    # A pending read offset is written along, pending records are appended later.
+                    box.write(self._header(path, read - end + MAILBOX_HEADER_SIZE, first + archive).encode())
+                    shutil.copyfileobj(file, box, READ_BLOCK)
+                self._shift_terms(path, first + archive, end - MAILBOX_HEADER_SIZE)
+                self._box_read.pop(path, None)
+            for start, _, stale in self._archives(user):
+                if start >= first and stale != name:
+                    rm_file(self._path(stale))
+        return archive
+
+    def _archives(self, user):
+        """Return the (first, end, name) tuples of the archive segments of the user, ordered by first."""
+        extensions = "|".join(extension for extension, _ in ARCHIVE_CODECS.values())
+        pattern = re.compile(r"{}\.box\.(\d+)-(\d+)\.(?:{})".format(re.escape(user), extensions))
+        try:
+            names = os.listdir(DATA)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            match = pattern.fullmatch(name)
+            if match:
+                segments.append((int(match.group(1)), int(match.group(2)), name))
+        return sorted(segments)
+
+    def _archive_chain(self, user):
+        """Return the (first, end, name) tuples of the archive segments that are in use.
+
+        Only the chain of segments from the first record up to the count of archived messages in
+        the mailbox header is used, so segments of interrupted compactions are skipped.
+        """
+        try:
+            with self._open(self._path('{}.box'.format(user))) as file:
+                archived = json.loads(file.readline()).get("archived", 0)
+        except (FileNotFoundError, ValueError):
+            return []
+        segments = []
+        position = 0
+        for first, end, name in self._archives(user):
+            if first == position and end <= archived:
+                segments.append((first, end, name))
+                position = end
+        return segments
+
+    def _open_segment(self, name):
+        """Open an archive segment for reading, decompressing it as it is read."""
+        modules = dict(ARCHIVE_CODECS.values())
+        STATS.add("file_opens")
+        return modules[name.rsplit('.', 1)[1]].open(self._path(name))
+
+    def _iter_archive(self, user, reverse=False):
+        """Yield the records of the user's archive segments, decompressing them as they are read.
+
+        With reverse, a segment is decompressed as a whole.
+        """
+        segments = self._archive_chain(user)
+        for _, _, name in reversed(segments) if reverse else segments:
+            with self._open_segment(name) as file:
+                records = self._decode(file)
+                yield from reversed(list(records)) if reverse else records
+
+    @staticmethod
+    def _decode(lines):
+        """Yield the records of JSON lines, skipping those that cannot be decoded."""
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    def groups(self):
+        """Return a list of the existing groups."""
+        return list(self._load('groups.txt', {}))
+
+    def group_exists(self, group):
+        """Return True if the group exists."""
+        return group in self._load('groups.txt', {})
+
+    def group_members(self, group):
+        """Return a list of the members of the group."""
+        return list(self._load('groups.txt', {}).get(group, []))
+
+    def add_group(self, group, members):
+        """Create a group with the given (existing) members."""
+        self._set_item('groups.txt', group, [])
+        for member in members:
+            self.add_member(group, member)
+
+    def add_member(self, group, member):
+        """Add a user to a group, updating both the group file and the user file.
+
+        The member's channel cursor starts at the end of the channel, so earlier group messages
+        are not shown to new members.
+        """
+        def add(d_group):
+            if group in d_group and member not in d_group[group]:
+                d_group[group].append(member)
+            return d_group
+
+        def join(d_user):
+            if group not in d_user["groups"]:
+                d_user["groups"].append(group)
+            d_user["channels"][group] = [end, end]
+        end = self._log_end(self._path('{}.chan'.format(group)))
+        self._update('groups.txt', add, {})
+        self._update_user(member, join)
+
+    def remove_member(self, group, member):
+        """Remove a user from a group, updating both the group file and the user file.
+
+        The group messages the member received are copied to its mailbox, so they are kept after
+        leaving the group.
+        """
+        self._remove_members(group, [member])
+
+    def _remove_members(self, group, members):
+        """Remove users from a group, reading its channel only once for all of them.
+
+        Args:
+            group: Name of the group.
+            members: Names of the users to be removed. The group messages they received are
+                copied to their mailboxes.
+        """
+        def remove(d_group):
+            for member in members:
+                if member in d_group.get(group, []):
+                    d_group[group].remove(member)
+            return d_group
+
+        def leave(d_user):
+            if group in d_user["groups"]:
+                d_user["groups"].remove(group)
+            d_user["channels"].pop(group, None)
+
+        def unsort(d_user):
+            # The copied messages may be older than messages already in the mailbox.
+            d_user["unsorted"] = True
+        if set(members) & set(self._load('groups.txt', {}).get(group, [])):
+            self._update('groups.txt', remove, {})
+        cursors = {member: self._cursors(member)[group] for member in members if group in self.groups_of(member)}
+        if not cursors:
+            return
+        path = self._path('{}.chan'.format(group))
+        entries = self._log_entries(path, min(joined for joined, _ in cursors.values()))[0]
+        for member, (joined, read) in cursors.items():
+            copied = False
+            for end, record in entries:
+                if end > joined:
+                    self._add_entry(member, record, read=end <= read)
+                    copied = True
+            if copied and not self._user(member).get("unsorted"):
+                self._update_user(member, unsort)
+            self._update_user(member, leave)
+
+    def remove_group(self, group):
+        """Remove a group and the memberships of its remaining members."""
+        self._remove_members(group, self.group_members(group))
+        self._pop_item('groups.txt', group)
+        self._unqueue(self._path('{}.chan'.format(group)))
+        self._store('{}.chan'.format(group), None)
+        self._store('.search/{}.chan.terms'.format(group), None)
+        self._store('.search/{}.chan.post'.format(group), None)
+
+    def _log_end(self, path):
+        """Return the offset behind the last record of a mailbox or channel, pending ones included."""
+        try:
+            end = os.path.getsize(path)
+        except FileNotFoundError:
+            end = len(self._header(path))
+        return end + self._box_sizes.get(path, 0)
+
+    def _read_log(self, path, offset):
+        """Read the records of a mailbox or channel behind an offset, pending ones included.
+
+        Args:
+            path: Path of the mailbox or channel file.
+            offset: Byte offset from which on the records are to be read.
+
+        Returns:
+            Tuple of the list of records and the offset behind the last of them.
+        """
+        entries, offset = self._log_entries(path, offset)
+        return [record for _, record in entries], offset
+
+    def _log_entries(self, path, offset):
+        """Like _read_log, but return (offset behind the record, record) tuples instead of records."""
+        entries = list(self._iter_entries(path, offset))
+        return entries, entries[-1][0] if entries else offset
+
+    def _iter_entries(self, path, offset):
+        """Yield the (offset behind the record, record) tuples of a mailbox or channel behind an offset.
+
+        The file is read record by record, pending records are yielded last.
+        """
+        end = len(self._header(path))
+        try:
+            with self._open(path, 'rb') as file:
+                file.seek(offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        # Incomplete record of an interrupted append.
+                        break
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield offset, record
+                end = file.tell()
+        except FileNotFoundError:
+            pass
+        for entry in list(self._box_appends.get(path, [])):
+            start = end
+            end += len(json.dumps(entry)) + 1
+            if start >= offset:
+                yield end, entry
+            offset = max(offset, end)
+
+    def _iter_entries_reversed(self, path, offset):
+        """Like _iter_entries, but from the last record backwards.
+
+        The file is read in blocks of READ_BLOCK bytes from its end, so only the blocks holding the
+        records that are consumed are read.
+        """
+        try:
+            file = self._open(path, 'rb')
+        except FileNotFoundError:
+            file = None
+        size = os.fstat(file.fileno()).st_size if file else len(self._header(path))
+        pending = []
+        end = size
+        for entry in self._box_appends.get(path, []):
+            end += len(json.dumps(entry)) + 1
+            pending.append((end, entry))
+        for end, entry in reversed(pending):
+            if end - len(json.dumps(entry)) - 1 >= offset:
+                yield end, entry
+        if file is None:
+            return
+        with file:
+            position = end = size
+            carried = b""
+            while position > offset:
+                start = max(offset, position - READ_BLOCK)
+                file.seek(start)
+                data = file.read(position - start) + carried
+                position = start
+                lines = data.split(b"\n")
+                tail = lines.pop()
+                pieces = [line + b"\n" for line in lines] + ([tail] if tail else [])
+                # The first piece may start in the block before, unless the offset has been reached.
+                carried = pieces.pop(0) if position > offset else b""
+                for piece in reversed(pieces):
+                    if piece.endswith(b"\n"):
+                        try:
+                            yield end, json.loads(piece)
+                        except ValueError:
+                            pass
+                    end -= len(piece)
+
+    def iter_messages(self, user, sender=None, since=None, reverse=False, archive=False):
+        """Yield the messages of the user's mailbox and channels in the order of their time.
+
+        The mailbox and the channels are read record by record and merged, so only one record per
+        file is held in memory. With reverse, they are read backwards from their ends, so the
+        latest messages come first without reading the earlier ones. Group messages copied to the
+        mailbox when the user left a group may be older than the messages before them, so the
+        mailbox and archive of such a user (marked "unsorted" in the user file) are sorted in
+        memory instead.
+
+        Args:
+            user: Name of the user whose messages are to be yielded.
+            sender: Only yield the messages of this sender.
+            since: Only yield the messages sent at or after this time.
+            reverse: Yield the latest message first.
+            archive: Also yield the archived messages.
+        """
+        if not self.user_exists(user):
+            return
+        self._migrate(user)
+        read = self._iter_entries_reversed if reverse else self._iter_entries
+        paths = [(self._path('{}.box'.format(user)), MAILBOX_HEADER_SIZE)]
+        paths.extend((self._path('{}.chan'.format(group)), joined)
+                     for group, (joined, _) in sorted(self._cursors(user).items()))
+        sources = [(Message.from_record(record, user, end) for end, record in read(path, offset))
+                   for path, offset in paths]
+        if archive:
+            sources.insert(1, (Message.from_record(record, user) for record in self._iter_archive(user, reverse)))
+        key = operator.attrgetter("time")
+        if self._user(user).get("unsorted"):
+            sources[:1 + archive] = [iter(sorted(source, key=key, reverse=reverse)) for source in sources[:1 + archive]]
+        if since is not None:
+            sources = [self._since(source, since, reverse) for source in sources]
+        for message in heapq.merge(*sources, key=key, reverse=reverse):
+            if sender is None or message.sender == sender:
+                yield message
+
+    @staticmethod
+    def _since(messages, since, reverse):
+        """Yield the messages sent at or after since, stopping at the first earlier one if reverse.
+
+        Args:
+            messages: Iterable of messages ordered by time.
+            since: Time of the earliest message to yield.
+            reverse: The messages come latest first.
+        """
+        for message in messages:
+            if message.time >= since:
+                yield message
+            elif reverse:
+                return
+
+    def search(self, user, terms):
+        """Return the messages of the user's mailbox, archive and channels holding all terms.
+
+        The record numbers are looked up in the search indexes, then only the matching records
+        are read, decompressing only the archive segments holding some of them.
+
+        Args:
+            user: Name of the user whose messages are to be searched.
+            terms: Search terms as returned by index_terms.
+
+        Returns:
+            List of the messages in the order of their time.
+        """
+        if not self.user_exists(user) or not terms:
+            return []
+        self._migrate(user)
+        logs = [(self._path('{}.box'.format(user)), -1)]
+        logs.extend((self._path('{}.chan'.format(group)), joined)
+                    for group, (joined, _) in sorted(self._cursors(user).items()))
+        messages = []
+        for path, joined in logs:
+            found = self._search_log(path, terms)
+            if found is None:
+                self.rebuild_terms(path)
+                found = self._search_log(path, terms) or []
+            found.extend(self._search_pending(path, terms))
+            messages.extend(Message.from_record(record, user, end) for end, record in found if end > joined)
+        return sorted(messages, key=lambda message: message.time)
+
+    def _search_log(self, path, terms):
+        """Return the (offset behind, record) tuples of a mailbox or channel holding all terms.
+
+        Archived records have the offset 0. None is returned if the search index is missing or
+        does not match the records.
+        """
+        index = self._terms(path)
+        if index is None:
+            return None
+        numbers = set(index.lookup(terms[0]))
+        for term in terms[1:]:
+            numbers.intersection_update(index.lookup(term))
+        records = {number: index.record(number) for number in numbers}
+        archived = {number for number in numbers if records[number][1] is None}
+        found = [(number, 0, record) for number, _, record in self._numbered(path, archived)]
+        if len(found) != len(archived):
+            return None
+        live = sorted(numbers - archived)
+        if live:
+            try:
+                file = self._open(path, 'rb')
+            except FileNotFoundError:
+                return None
+            with file:
+                for number in live:
+                    offset = records[number][1]
+                    file.seek(offset)
+                    line = file.readline()
+                    if not line.endswith(b"\n"):
+                        return None
+                    try:
+                        found.append((number, offset + len(line), json.loads(line)))
+                    except ValueError:
+                        return None
+        for number, _, record in found:
+            if record is None or Message.from_record(record, None).time != records[number][0]:
+                return None
+        return [(end, record) for _, end, record in found]
+
+    def _search_pending(self, path, terms):
+        """Return the (offset behind, record) tuples of the pending records of a file holding all terms."""
+        end = self._log_end(path) - self._box_sizes.get(path, 0)
+        found = []
+        for entry in self._box_appends.get(path, []):
+            end += len(json.dumps(entry)) + 1
+            if set(terms) <= set(index_terms(Message.from_record(entry, None).body)):
+                found.append((end, entry))
+        return found
+
+    def _terms(self, path):
+        """Return the search index of a mailbox or channel file as a TermIndex.
+
+        The index is kept in memory and only the lines appended since the last call are read.
+
+        Returns:
+            The TermIndex or None if there is no index or it is outdated.
+        """
+        index = self._terms_path(path)
+        try:
+            file = self._open(index, 'rb')
+        except FileNotFoundError:
+            return None
+        with file:
+            cached = self._search.get(index)
+            if cached is None:
+                cached = self._search[index] = TermIndex(index)
+            if not cached.update(file):
+                # Index of an earlier version without the offsets of the records.
+                cached.close()
+                del self._search[index]
+                return None
+        return cached
+
+    def _shift_terms(self, path, archived, shift):
+        """Move the offsets in the search index of a mailbox after it has been compacted.
+
+        Args:
+            path: Path of the mailbox file, whose lock must be held.
+            archived: Number of the archived records, whose offsets become null.
+            shift: Number of bytes the remaining records moved to the front.
+        """
+        index = self._terms_path(path)
+        try:
+            with self._open(index, 'rb') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+        entries = []
+        for number, line in enumerate(lines):
+            if not line.endswith(b"\n"):
+                break
+            entry = json.loads(line)
+            if len(entry) < 3:
+                # Outdated index, rebuilt on the next search.
+                return
+            if number < archived or entry[2] is None:
+                entry[2] = None
+            else:
+                entry[2] -= shift
+            entries.append(entry)
+        self._write_terms(index, "".join(json.dumps(entry) + "\n" for entry in entries).encode())
+
+    def _numbered(self, path, numbers=None):
+        """Yield the (number, offset, record) tuples of the records of a mailbox or channel.
+
+        Records are numbered from the first archived one on. The offset is where the record
+        starts in the file, None for archived records. Records that cannot be decoded are yielded
+        as None.
+
+        Args:
+            path: Path of the mailbox or channel file.
+            numbers: Only yield the records of these numbers, all if None.
+        """
+        last = max(numbers, default=-1) if numbers is not None else None
+        position = 0
+        if path.endswith('.box'):
+            for first, end, name in self._archive_chain(os.path.basename(path)[:-4]):
+                position = end
+                if numbers is not None and not any(first <= number < end for number in numbers):
+                    continue
+                with self._open_segment(name) as file:
+                    for number, line in enumerate(file, first):
+                        if numbers is None or number in numbers:
+                            try:
+                                yield number, None, json.loads(line)
+                            except ValueError:
+                                yield number, None, None
+        if last is not None and last < position:
+            return
+        try:
+            file = self._open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            offset = len(file.readline())
+            for number, line in enumerate(file, position):
+                if not line.endswith(b"\n") or last is not None and number > last:
+                    break
+                if numbers is None or number in numbers:
+                    try:
+                        yield number, offset, json.loads(line)
+                    except ValueError:
+                        yield number, offset, None
+                offset += len(line)
+
+    def rebuild_terms(self, path):
+        """Write the search index of a mailbox or channel anew from its records."""
+        with self._locked(path):
+            if not os.path.exists(path):
+                return
+            terms = [self._index_entry(record) + [offset] for _, offset, record in self._numbered(path)]
+            index = self._terms_path(path)
+            os.makedirs(os.path.dirname(index), exist_ok=True)
+            self._write_terms(index, "".join(json.dumps(entry) + "\n" for entry in terms).encode())
+
+    def rebuild_index(self):
+        """Rebuild the search indexes of all mailboxes and channels."""
+        for user in self.users():
+            self._migrate(user)
+            self.rebuild_terms(self._path('{}.box'.format(user)))
+        for group in self.groups():
+            self.rebuild_terms(self._path('{}.chan'.format(group)))
+
+    def _cursors(self, user):
+        """Return the [joined, read] channel offsets of the user, adding missing ones."""
+        d_user = self._user(user)
+        ends = {group: self._log_end(self._path('{}.chan'.format(group)))
+                for group in d_user["groups"] if group not in d_user["channels"]}
+
+        def add(d_user):
+            for group, end in ends.items():
+                if group in d_user["groups"]:
+                    d_user["channels"].setdefault(group, [end, end])
+        if ends:
+            self._update_user(user, add)
+        return self._user(user)["channels"]
+
+    def append_channel(self, group, message):
+        """Append a message to the channel of a group. It is stored once for all members."""
+        self._queue(self._path('{}.chan'.format(group)), message.record())
+
+    def channel_messages(self, user, unread=False):
+        """Return the group messages of the user.
+
+        Args:
+            user: Name of the user whose group messages are to be returned.
+            unread: Only return the messages behind the read cursors.
+
+        Returns:
+            Tuple of the list of messages and a dict of the new read cursor per group.
+        """
+        messages = []
+        ends = {}
+        if not self.user_exists(user):
+            return messages, ends
+        for group, (joined, read) in sorted(self._cursors(user).items()):
+            new, ends[group] = self._read_messages(self._path('{}.chan'.format(group)), read if unread else joined, user)
+            messages.extend(new)
+        return messages, ends
+
+    def mark_channels_read(self, user, ends):
+        """Move the read cursors of the user's channels, e.g. to the offsets of channel_messages."""
+        channels = self._cursors(user)
+        moved = {group: end for group, end in ends.items() if group in channels and channels[group][1] != end}
+
+        def move(d_user):
+            for group, end in moved.items():
+                if group in d_user["channels"]:
+                    d_user["channels"][group][1] = end
+        if moved:
+            self._update_user(user, move)
+
+    def watch_token(self, user):
+        """Return a value that changes when the user may have received messages from another process.
+
+        It is made of the inode and size of the user's file, mailbox and channels, so moving the
+        read offsets of the user does not change it.
+        """
+        names = ['{}.txt'.format(user), '{}.box'.format(user)]
+        names.extend('{}.chan'.format(group) for group in self.groups_of(user))
+        stamps = [self._stamp(self._path(name)) for name in names]
+        return tuple(None if stamp is None else stamp[0::2] for stamp in stamps)
+
+    def _tickets(self):
+        """Return the session store, updated with the changes of other processes.
+
+        The tickets of the pickled .tickets.txt of earlier versions are moved to the log.
+        """
+        if self._sessions_checked != DATA:
+            self._sessions_checked = DATA
+            old = self._load('.tickets.txt')
+            if old is not None:
+                self._sessions.load(self._path('.tickets.log'))
+                for user, stamp in old.items():
+                    self._sessions.set(user, stamp)
+                self._store('.tickets.txt', None)
+                self.commit()
+        self._sessions.load(self._path('.tickets.log'))
+        return self._sessions
+
+    def ticket(self, user):
+        """Return the login time of the user's ticket or None if it has none or it expired."""
+        return self._tickets().get(user)
+
+    def set_ticket(self, user, stamp):
+        """Set the login time of the user's ticket."""
+        self._tickets().set(user, stamp)
+
+    def drop_ticket(self, user):
+        """Remove the ticket of the user."""
+        self._tickets().drop(user)
+
+    def _log_records(self, path):
+        """Return a list of the records of a mailbox or channel with the offset behind each of them."""
+        return self._log_entries(path, len(self._header(path)))[0]
+
+    def convert(self):
+        """Write the password, group and user files again in the format of CODEC.
+
+        Returns:
+            Number of files written.
+        """
+        names = ['passes.txt', 'groups.txt'] + ['{}.txt'.format(user) for user in self.users()]
+        count = 0
+        with self.batch():
+            for name in names:
+                obj = self._load(name)
+                if obj is not None:
+                    self._store(name, obj)
+                    count += 1
+        return count
+
+    def export(self):
+        """Return the whole content of the data directory in a backend independent form.
+
+        Read cursors are given as numbers of records instead of byte offsets.
+
+        Returns:
+            Dict with the "users" (password, messages including the archived ones, read,
+            channels), "groups" (members, messages) and "tickets".
+        """
+        def count(records, offset):
+            return sum(1 for end, _ in records if end <= offset)
+
+        channels = {}
+        groups = {}
+        for group in self.groups():
+            channels[group] = self._log_records(self._path('{}.chan'.format(group)))
+            groups[group] = {"members": self.group_members(group),
+                             "messages": [Message.from_record(record, None).record() for _, record in channels[group]]}
+        users = {}
+        for user in self.users():
+            if not self.user_exists(user):
+                continue
+            self._migrate(user)
+            path = self._path('{}.box'.format(user))
+            records = self._log_records(path)
+            archived = list(self._iter_archive(user))
+            cursors = {}
+            for group in self.groups_of(user):
+                joined, read = self._cursors(user)[group]
+                if group in channels:
+                    cursors[group] = [count(channels[group], joined), count(channels[group], read)]
+            users[user] = {"password": self.password(user),
+                           "messages": [Message.from_record(record, user).record()
+                                        for record in archived + [record for _, record in records]],
+                           "read": len(archived) + count(records, self._read_offset(path)),
+                           "channels": cursors}
+        tickets = self._tickets().tickets()
+        return {"users": users, "groups": groups, "tickets": tickets}
+
+class TermIndex:
+    """Inverted search index of a mailbox or channel: term -> record numbers, with the time and
+    offset of every record.
+
+    The index is read from the .terms file of the records, see DataStore. A snapshot of its first
+    lines is kept in a .post file next to it: a JSON header line, a table of the times and offsets
+    of the records and one line '<term> <number> ...' per term, sorted by term. Terms are looked up
+    by a binary search in the memory mapped snapshot, so a process does not have to invert the
+    whole index before its first search. Only the lines appended to the .terms file after the
+    snapshot are inverted in memory, and the snapshot is written anew once they are more than
+    SEARCH_DELTA.
+    """
+
+    RECORD = struct.Struct("<dq")
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self.snapshot_path(path)
+        self.ino = None
+        self.size = 0
+        self.base = 0
+        self.map = None
+        self.terms_at = 0
+        self.inverted = {}
+        self.times = []
+        self.offsets = []
+
+    @staticmethod
+    def snapshot_path(path):
+        """Return the path of the snapshot of the .terms file at path."""
+        return path[:-len(".terms")] + ".post"
+
+    def update(self, file):
+        """Read the lines appended to the open .terms file since the last call.
+
+        Returns:
+            False if the index is of an earlier version without the offsets of the records.
+        """
+        stat = os.fstat(file.fileno())
+        if self.ino != stat.st_ino or self.size > stat.st_size:
+            self._reset(file, stat.st_ino)
+        file.seek(self.size)
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            entry = json.loads(line)
+            if len(entry) < 3:
+                return False
+            self.size += len(line)
+            for word in entry[1]:
+                self.inverted.setdefault(word, []).append(self.base + len(self.times))
+            self.times.append(entry[0])
+            self.offsets.append(entry[2])
+        if len(self.times) > SEARCH_DELTA:
+            if self.base:
+                # The snapshot is written from the whole index.
+                self._reset(file, stat.st_ino, snapshot=False)
+                return self.update(file)
+            self._save(file)
+        return True
+
+    def _reset(self, file, ino, snapshot=True):
+        """Start reading the .terms file anew, from the end of a matching snapshot if there is one."""
+        self.close()
+        self.ino = ino
+        self.size = self.base = 0
+        self.inverted, self.times, self.offsets = {}, [], []
+        if not snapshot:
+            return
+        try:
+            with open(self.snapshot, 'rb') as post:
+                header = post.readline()
+                data = mmap.mmap(post.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        try:
+            info = json.loads(header)
+            if info["ino"] != ino:
+                raise ValueError(info["ino"])
+            tail = info["tail"].encode()
+            file.seek(info["size"] - len(tail))
+            matches = file.read(len(tail)) == tail
+        except (ValueError, KeyError, OSError):
+            matches = False
+        if not matches:
+            data.close()
+            return
+        self.map = data
+        self.size = info["size"]
+        self.base = info["count"]
+        self.terms_at = len(header) + self.base * self.RECORD.size
+
+    def _save(self, file):
+        """Write the snapshot of the index read so far, which must start at the first line."""
+        file.seek(max(self.size - 256, 0))
+        last = file.read(self.size - file.tell())
+        tail = last[last.rfind(b"\n", 0, len(last) - 1) + 1:].decode(errors="replace")
+        if tail.encode() != last[len(last) - len(tail.encode()):]:
+            return
+        header = json.dumps({"ino": self.ino, "size": self.size, "count": len(self.times), "tail": tail}) + "\n"
+        records = b"".join(self.RECORD.pack(float("nan") if stamp is None else stamp, -1 if offset is None else offset)
+                           for stamp, offset in zip(self.times, self.offsets))
+        postings = sorted((word.encode(), numbers) for word, numbers in self.inverted.items())
+        lines = b"".join(word + b" " + " ".join(map(str, numbers)).encode() + b"\n" for word, numbers in postings)
+        DataStore._write(self.snapshot, header.encode() + records + lines)
+        self._reset(file, self.ino)
+        self.update(file)
+
+    def close(self):
+        """Release the memory map of the snapshot."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def lookup(self, term):
+        """Return the numbers of the records holding a term."""
+        numbers = []
+        if self.map is not None:
+            key = term.encode()
+            low, high = self.terms_at, len(self.map)
+            while low < high:
+                middle = (low + high) // 2
+                start = max(self.map.rfind(b"\n", self.terms_at, middle) + 1, self.terms_at)
+                end = self.map.find(b"\n", middle) + 1
+                if self.map[start:end].split(b" ", 1)[0] < key:
+                    low = end
+                else:
+                    high = start
+            end = self.map.find(b"\n", low) + 1
+            word, _, rest = self.map[low:end].partition(b" ")
+            if end and word == key:
+                numbers = [int(number) for number in rest.split()]
+        return numbers + self.inverted.get(term, [])
+
+    def record(self, number):
+        """Return the (time, offset) of a record. The offset is None for archived records."""
+        if number >= self.base:
+            return self.times[number - self.base], self.offsets[number - self.base]
+        stamp, offset = self.RECORD.unpack_from(self.map, self.terms_at - (self.base - number) * self.RECORD.size)
+        return (None if stamp != stamp else stamp), (None if offset < 0 else offset)
+
+class SessionStore:
+    """Login tickets held in memory and persisted as an append-only log.
+
+    The tickets map users to their login time. A min-heap of (login time, user) entries orders
+    them by expiry, so tickets older than TICKET_TTL are removed lazily from its top whenever
+    tickets are accessed. Entries of replaced or dropped tickets stay in the heap until they
+    reach the top. Checking, setting and dropping a ticket take O(log n).
+
+    Changes are appended to the log as JSON lines [user, login time], or [user, null] for a
+    dropped ticket. The log is read incrementally, so the changes of other processes are picked
+    up by reading the lines appended since. Once it holds more than COMPACT_RATIO lines per live
+    ticket, it is rewritten with the live tickets only, so it does not grow with dead sessions.
+    """
+
+    COMPACT_RATIO = 4
+    COMPACT_MIN = 64
+
+    def __init__(self):
+        self._path = None
+        self._inode = None
+        self._offset = 0
+        self._lines = 0
+        self._tickets = {}
+        self._heap = []
+        self.pending = []
+
+    def load(self, path):
+        """Read the lines appended to the log since the last call, all of it if it was replaced."""
+        try:
+            file = DataStore._open(path, 'rb')
+        except FileNotFoundError:
+            file = None
+        inode = os.fstat(file.fileno()).st_ino if file else None
+        changed = path != self._path or inode != self._inode
+        if changed:
+            self._path = path
+            self._inode = inode
+            self._offset = self._lines = 0
+            self._tickets = {}
+            self._heap = []
+        if file is not None:
+            with file:
+                file.seek(self._offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._offset += len(line)
+                    self._lines += 1
+                    try:
+                        user, stamp = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(user, stamp)
+                    changed = True
+        if changed:
+            # Changes that are not written yet come after those of the log.
+            for user, stamp in self.pending:
+                self._apply(user, stamp)
+
+    def _apply(self, user, stamp):
+        if stamp is None:
+            self._tickets.pop(user, None)
+        else:
+            self._tickets[user] = stamp
+            heapq.heappush(self._heap, (stamp, user))
+
+    def _sweep(self):
+        """Remove the expired tickets from the top of the heap."""
+        expired = time.time() - TICKET_TTL
+        heap = self._heap
+        while heap and (heap[0][0] <= expired or self._tickets.get(heap[0][1]) != heap[0][0]):
+            stamp, user = heapq.heappop(heap)
+            if self._tickets.get(user) == stamp:
+                del self._tickets[user]
+        if len(heap) > self.COMPACT_RATIO * len(self._tickets) + self.COMPACT_MIN:
+            self._heap = [(stamp, user) for user, stamp in self._tickets.items()]
+            heapq.heapify(self._heap)
+
+    def get(self, user):
+        """Return the login time of the user's ticket or None if it has none or it expired."""
+        self._sweep()
+        return self._tickets.get(user)
+
+    def set(self, user, stamp):
+        """Set the login time of the user's ticket. It is written on the next flush."""
+        self._apply(user, stamp)
+        self.pending.append((user, stamp))
+
+    def drop(self, user):
+        """Remove the ticket of the user. It is written on the next flush."""
+        if user in self._tickets:
+            self._apply(user, None)
+            self.pending.append((user, None))
+
+    def tickets(self):
+        """Return a dict of the login times of the live tickets."""
+        self._sweep()
+        return dict(self._tickets)
+
+    def lines(self):
+        """Return the pending changes as lines of the log."""
+        return "".join(json.dumps([user, stamp]) + "\n" for user, stamp in self.pending).encode()
+
+    def flush(self, path):
+        """Write the pending changes to the log, compacting it if it holds too many dead lines.
+
+        The caller holds the lock of the log.
+        """
+        self.load(path)
+        self._sweep()
+        if self._lines + len(self.pending) > max(self.COMPACT_MIN, self.COMPACT_RATIO * len(self._tickets)):
+            self.pending = list(self._tickets.items())
+            DataStore._write(path, self.lines())
+            self._lines = len(self.pending)
+        else:
+            with DataStore._open(path, 'ab') as file:
+                if file.tell() > self._offset:
+                    # Terminate the incomplete line of an interrupted append.
+                    file.write(b"\n")
+                file.write(self.lines())
+            self._lines += len(self.pending)
+        stat = os.stat(path)
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+        self.pending = []
+
+    def rollback(self):
+        """Drop the pending changes. The tickets are read from the log again on the next load."""
+        self.pending = []
+        self._inode = None
+        self._path = None
+
+class SQLiteStore(BaseStore):
+    """SQLite storage backend with the same interface as DataStore.
+
+    Users, groups, memberships, messages and tickets live in indexed tables of
+    DATA/messenger.db, which runs in WAL mode. Direct messages have a user, group messages a group,
+    and group messages copied to a member who left the group both. Read cursors are message ids
+    instead of byte offsets. Compacted direct messages are kept as compressed JSON lines in the
+    archives table. The terms table is the inverted search index, mapping every term to the ids
+    of the messages holding it, archived ones included.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, password BLOB,
+                                          last_read INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS members (grp TEXT NOT NULL, user TEXT NOT NULL, joined INTEGER NOT NULL,
+                                            last_read INTEGER NOT NULL, PRIMARY KEY (grp, user));
+        CREATE INDEX IF NOT EXISTS members_user ON members (user);
+        CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT, grp TEXT,
+                                             sender TEXT, body TEXT NOT NULL, time REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS messages_user ON messages (user, id);
+        CREATE INDEX IF NOT EXISTS messages_grp ON messages (grp, id);
+        CREATE TABLE IF NOT EXISTS tickets (user TEXT PRIMARY KEY, time REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS tickets_time ON tickets (time);
+        CREATE TABLE IF NOT EXISTS archives (user TEXT NOT NULL, first INTEGER NOT NULL, last INTEGER NOT NULL,
+                                             codec TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (user, first));
+        CREATE TABLE IF NOT EXISTS terms (term TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (term, id))
+            WITHOUT ROWID;
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._db = None
+        self._db_path = None
+
+    @property
+    def db(self):
+        """Connection to the database of the current data directory."""
+        path = '{}/messenger.db'.format(DATA)
+        if self._db is None or self._db_path != path:
+            self.close()
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(self.SCHEMA)
+            self._upgrade()
+            self._db_path = path
+        return self._db
+
+    def _upgrade(self):
+        """Split the message texts of a database of an earlier version into sender, group and body.
+
+        The search index is built if the database has none yet.
+        """
+        if "sender" not in [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]:
+            with self._db:
+                self._db.execute("ALTER TABLE messages ADD COLUMN sender TEXT")
+                rows = self._db.execute("SELECT id, user, grp, body FROM messages").fetchall()
+                for msg_id, user, group, body in rows:
+                    message = Message.parse(body, user)
+                    self._db.execute("UPDATE messages SET grp = ?, sender = ?, body = ? WHERE id = ?",
+                                     (group or message.group, message.sender, message.body, msg_id))
+        if not self._db.execute("PRAGMA user_version").fetchone()[0]:
+            with self._db:
+                self._index_all()
+                self._db.execute("PRAGMA user_version = 1")
+
+    def _index_all(self):
+        """Fill the search index anew from all messages, archived ones included."""
+        self._db.execute("DELETE FROM terms")
+        for msg_id, body in self._db.execute("SELECT id, body FROM messages").fetchall():
+            self._index_message(msg_id, body)
+        for codec, data in self._db.execute("SELECT codec, data FROM archives").fetchall():
+            for msg_id, _, _, _, body in self._decode_archive(codec, data):
+                self._index_message(msg_id, body)
+
+    def _index_message(self, msg_id, body):
+        """Add the terms of a message to the search index."""
+        self._db.executemany("INSERT OR IGNORE INTO terms (term, id) VALUES (?, ?)",
+                             [(term, msg_id) for term in index_terms(body)])
+
+    @staticmethod
+    def _decode_archive(codec, data):
+        """Return the [id, sender, group, time, body] records of a compressed row of the archives table."""
+        return [json.loads(line) for line in ARCHIVE_CODECS[codec][1].decompress(data).splitlines()]
+
+    def close(self):
+        """Close the database connection."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def remove(self):
+        """Close the database and remove its files from the data directory."""
+        self.close()
+        for suffix in ["", "-wal", "-shm"]:
+            rm_file("{}/messenger.db{}".format(DATA, suffix))
+
+    def commit(self):
+        """Commit the current transaction unless inside a batch.
+
+        Returns:
+            Empty list, as there are no partially failed appends.
+        """
+        if not self._depth and self.db.in_transaction:
+            with STATS.timing("store", "commit"):
+                self.db.commit()
+        return []
+
+    def rollback(self):
+        """Roll back the current transaction."""
+        self.db.rollback()
+
+    def _column(self, query, *args):
+        return [row[0] for row in self.db.execute(query, args)]
+
+    def _last_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def _messages(self, user, query, *args):
+        """Return the messages of the user selected by a query for id, sender, grp, body and time."""
+        return [Message(sender, user, body, stamp, group, msg_id)
+                for msg_id, sender, group, body, stamp in self.db.execute(query, args)]
+
+    def users(self):
+        """Return a list of the existing users."""
+        return self._column("SELECT name FROM users ORDER BY rowid")
+
+    def user_exists(self, user):
+        """Return True if the user exists."""
+        return bool(self._column("SELECT 1 FROM users WHERE name = ?", user))
+
+    def password(self, user):
+        """Return the [hash, salt, algorithm, iterations] entry of the user or None."""
+        rows = self._column("SELECT password FROM users WHERE name = ?", user)
+        return decode(rows[0]) if rows else None
+
+    def set_password(self, user, password):
+        """Replace the password entry of the user."""
+        self.db.execute("UPDATE users SET password = ? WHERE name = ?", (encode(password), user))
+
+    def add_user(self, user, password):
+        """Register a new user with its password entry."""
+        self.db.execute("INSERT INTO users (name, password, last_read) VALUES (?, ?, ?)",
+                        (user, encode(password), self._last_id()))
+
+    def remove_user(self, user):
+        """Remove the user with its messages, memberships and ticket."""
+        self.db.execute("DELETE FROM terms WHERE id IN (SELECT id FROM messages WHERE user = ?)", (user,))
+        for table, column in (("users", "name"), ("messages", "user"), ("members", "user"), ("tickets", "user"),
+                              ("archives", "user")):
+            self.db.execute("DELETE FROM {} WHERE {} = ?".format(table, column), (user,))
+
+    def groups_of(self, user):
+        """Return a list of the groups of the user."""
+        return self._column("SELECT grp FROM members WHERE user = ? ORDER BY rowid", user)
+
+    def messages(self, user):
+        """Return a list of the user's direct messages."""
+        return self._messages(user, "SELECT id, sender, grp, body, time FROM messages WHERE user = ? ORDER BY id", user)
+
+    def new_messages(self, user):
+        """Return the unread direct messages of the user.
+
+        Returns:
+            Tuple of the list of messages and the id of the last of them.
+        """
+        read = self._column("SELECT last_read FROM users WHERE name = ?", user)
+        if not read:
+            return [], 0
+        messages = self._messages(user, "SELECT id, sender, grp, body, time FROM messages "
+                                        "WHERE user = ? AND id > ? ORDER BY id", user, read[0])
+        return messages, messages[-1].seq if messages else read[0]
+
+    def mark_read(self, user, offset):
+        """Set the id of the last read direct message of the user."""
+        self.db.execute("UPDATE users SET last_read = ? WHERE name = ?", (offset, user))
+
+    def append_message(self, user, message):
+        """Add a direct message for the user."""
+        cursor = self.db.execute("INSERT INTO messages (user, sender, body, time) VALUES (?, ?, ?, ?)",
+                                 (user, message.sender, message.body, message.time))
+        self._index_message(cursor.lastrowid, message.body)
+
+    def compact(self, user, max_messages=None, max_age=None):
+        """Move the oldest read direct messages of the user to a compressed row of the archives table.
+
+        Args:
+            user: Name of the user whose messages are to be compacted.
+            max_messages: Number of messages to keep, None for no limit.
+            max_age: Age in seconds from which on read messages are archived, None for no limit.
+
+        Returns:
+            Number of archived messages.
+        """
+        read = self._column("SELECT last_read FROM users WHERE name = ?", user)
+        if not read:
+            return 0
+        count = self._column("SELECT COUNT(*) FROM messages WHERE user = ?", user)[0]
+        rows = self.db.execute("SELECT id, sender, grp, time, body FROM messages WHERE user = ? AND id <= ? "
+                               "ORDER BY id", (user, read[0])).fetchall()
+        old = 0
+        if max_age is not None:
+            while old < len(rows) and rows[old][3] < time.time() - max_age:
+                old += 1
+        archive = min(len(rows), max(old, 0 if max_messages is None else count - max_messages))
+        if archive <= 0:
+            return 0
+        rows = rows[:archive]
+        data = "".join(json.dumps(list(row)) + "\n" for row in rows).encode()
+        data = ARCHIVE_CODECS[ARCHIVE_CODEC][1].compress(data)
+        with self.batch():
+            self.db.execute("INSERT INTO archives (user, first, last, codec, data) VALUES (?, ?, ?, ?, ?)",
+                            (user, rows[0][0], rows[-1][0], ARCHIVE_CODEC, data))
+            self.db.execute("DELETE FROM messages WHERE user = ? AND id <= ?", (user, rows[-1][0]))
+        return archive
+
+    def _iter_archive(self, user, reverse=False):
+        """Yield the archived [sender, group, time, body] records of the user, decompressing one row at a time."""
+        rows = self.db.execute("SELECT codec, data FROM archives WHERE user = ? ORDER BY first {}".format(
+            "DESC" if reverse else "ASC"), (user,)).fetchall()
+        for codec, data in rows:
+            records = [record[1:] for record in self._decode_archive(codec, data)]
+            yield from reversed(records) if reverse else records
+
+    def groups(self):
+        """Return a list of the existing groups."""
+        return self._column("SELECT name FROM groups ORDER BY rowid")
+
+    def group_exists(self, group):
+        """Return True if the group exists."""
+        return bool(self._column("SELECT 1 FROM groups WHERE name = ?", group))
+
+    def group_members(self, group):
+        """Return a list of the members of the group."""
+        return self._column("SELECT user FROM members WHERE grp = ? ORDER BY rowid", group)
+
+    def add_group(self, group, members):
+        """Create a group with the given (existing) members."""
+        self.db.execute("INSERT INTO groups (name) VALUES (?)", (group,))
+        for member in members:
+            self.add_member(group, member)
+
+    def add_member(self, group, member):
+        """Add a user to a group. Earlier group messages are not shown to the new member."""
+        last = self._last_id()
+        self.db.execute("INSERT INTO members (grp, user, joined, last_read) VALUES (?, ?, ?, ?)",
+                        (group, member, last, last))
+
+    def remove_member(self, group, member):
+        """Remove a user from a group, copying the group messages it received to its direct messages."""
+        row = self.db.execute("SELECT joined, last_read FROM members WHERE grp = ? AND user = ?",
+                              (group, member)).fetchone()
+        if row is None:
+            return
+        joined, read = row
+        fully_read = self.new_messages(member)[0] == []
+        rows = self.db.execute("SELECT id, sender, body, time FROM messages WHERE grp = ? AND user IS NULL AND id > ? "
+                               "ORDER BY id", (group, joined)).fetchall()
+        for msg_id, sender, body, stamp in rows:
+            cursor = self.db.execute("INSERT INTO messages (user, grp, sender, body, time) VALUES (?, ?, ?, ?, ?)",
+                                     (member, group, sender, body, stamp))
+            self._index_message(cursor.lastrowid, body)
+            if fully_read and msg_id <= read:
+                self.mark_read(member, cursor.lastrowid)
+        self.db.execute("DELETE FROM members WHERE grp = ? AND user = ?", (group, member))
+
+    def remove_group(self, group):
+        """Remove a group, its memberships and its messages."""
+        for member in self.group_members(group):
+            self.remove_member(group, member)
+        self.db.execute("DELETE FROM groups WHERE name = ?", (group,))
+        self.db.execute("DELETE FROM terms WHERE id IN (SELECT id FROM messages WHERE grp = ? AND user IS NULL)",
+                        (group,))
+        self.db.execute("DELETE FROM messages WHERE grp = ? AND user IS NULL", (group,))
+
+    def append_channel(self, group, message):
+        """Add a group message. It is stored once for all members."""
+        cursor = self.db.execute("INSERT INTO messages (grp, sender, body, time) VALUES (?, ?, ?, ?)",
+                                 (group, message.sender, message.body, message.time))
+        self._index_message(cursor.lastrowid, message.body)
+
+    def channel_messages(self, user, unread=False):
+        """Return the group messages of the user.
+
+        Args:
+            user: Name of the user whose group messages are to be returned.
+            unread: Only return the messages behind the read cursors.
+
+        Returns:
+            Tuple of the list of messages and a dict of the new read cursor per group.
+        """
+        messages = []
+        ends = {}
+        cursors = self.db.execute("SELECT grp, joined, last_read FROM members WHERE user = ?", (user,)).fetchall()
+        for group, joined, read in cursors:
+            new = self._messages(user, "SELECT id, sender, grp, body, time FROM messages "
+                                       "WHERE grp = ? AND user IS NULL AND id > ? ORDER BY id",
+                                 group, read if unread else joined)
+            messages.extend(new)
+            ends[group] = max(read, new[-1].seq) if new else read
+        return messages, ends
+
+    def iter_messages(self, user, sender=None, since=None, reverse=False, archive=False):
+        """Yield the messages of the user's mailbox and groups in the order of their time.
+
+        Filtering and ordering are done by the database, and the rows are fetched as they are
+        consumed. Archived messages are filtered after decompressing them.
+
+        Args:
+            user: Name of the user whose messages are to be yielded.
+            sender: Only yield the messages of this sender.
+            since: Only yield the messages sent at or after this time.
+            reverse: Yield the latest message first.
+            archive: Also yield the archived messages.
+        """
+        conditions = ""
+        args = []
+        if sender is not None:
+            conditions += " AND m.sender = ?"
+            args.append(sender)
+        if since is not None:
+            conditions += " AND m.time >= ?"
+            args.append(since)
+        query = ("SELECT m.id, m.sender, m.grp, m.body, m.time FROM messages m WHERE m.user = ?{0} UNION ALL "
+                 "SELECT m.id, m.sender, m.grp, m.body, m.time FROM messages m JOIN members b "
+                 "ON m.grp = b.grp AND m.user IS NULL AND m.id > b.joined WHERE b.user = ?{0} "
+                 "ORDER BY 5 {1}, 1 {1}").format(conditions, "DESC" if reverse else "ASC")
+        messages = (Message(msg_sender, user, body, stamp, group, msg_id)
+                    for msg_id, msg_sender, group, body, stamp in self.db.execute(query, [user] + args + [user] + args))
+        if archive:
+            archived = (Message.from_record(record, user) for record in self._iter_archive(user, reverse))
+            archived = (message for message in archived
+                        if (sender is None or message.sender == sender) and (since is None or message.time >= since))
+            messages = heapq.merge(archived, messages, key=lambda message: message.time, reverse=reverse)
+        yield from messages
+
+    def search(self, user, terms):
+        """Return the direct, group and archived messages of the user holding all terms.
+
+        Args:
+            user: Name of the user whose messages are to be searched.
+            terms: Search terms as returned by index_terms.
+
+        Returns:
+            List of the messages in the order of their time.
+        """
+        if not terms:
+            return []
+        ids = self._column(" INTERSECT ".join(["SELECT id FROM terms WHERE term = ?"] * len(terms)), *terms)
+        if not ids:
+            return []
+        found = set(ids)
+        messages = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            messages.extend(self._messages(
+                user, "SELECT m.id, m.sender, m.grp, m.body, m.time FROM messages m WHERE m.id IN ({}) AND "
+                      "(m.user = ? OR m.user IS NULL AND m.id > (SELECT joined FROM members b "
+                      "WHERE b.grp = m.grp AND b.user = ?))".format(", ".join("?" * len(chunk))), *chunk, user, user))
+        archives = self.db.execute("SELECT first, last, codec FROM archives WHERE user = ?", (user,)).fetchall()
+        for first, last, codec in archives:
+            if any(first <= msg_id <= last for msg_id in found):
+                data = self._column("SELECT data FROM archives WHERE user = ? AND first = ?", user, first)[0]
+                messages.extend(Message(sender, user, body, stamp, group, msg_id)
+                                for msg_id, sender, group, stamp, body in self._decode_archive(codec, data)
+                                if msg_id in found)
+        return sorted(messages, key=lambda message: message.time)
+
+    def rebuild_index(self):
+        """Rebuild the search index from all messages."""
+        with self.batch():
+            self._index_all()
+
+    def mark_channels_read(self, user, ends):
+        """Move the read cursors of the user's groups, e.g. to the ids of channel_messages."""
+        self.db.executemany("UPDATE members SET last_read = ? WHERE grp = ? AND user = ?",
+                            [(end, group, user) for group, end in ends.items()])
+
+    def watch_token(self, user):
+        """Return a value that changes when another process committed to the database, see DataStore."""
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def ticket(self, user):
+        """Return the login time of the user's ticket or None if it has none or it expired."""
+        rows = self._column("SELECT time FROM tickets WHERE user = ? AND time > ?", user, time.time() - TICKET_TTL)
+        return rows[0] if rows else None
+
+    def set_ticket(self, user, stamp):
+        """Set the login time of the user's ticket, removing the expired tickets on the way."""
+        self.db.execute("DELETE FROM tickets WHERE time <= ?", (time.time() - TICKET_TTL,))
+        self.db.execute("INSERT OR REPLACE INTO tickets (user, time) VALUES (?, ?)", (user, stamp))
+
+    def drop_ticket(self, user):
+        """Remove the ticket of the user."""
+        self.db.execute("DELETE FROM tickets WHERE user = ?", (user,))
+
+    def convert(self):
+        """Encode the password entries again in the format of CODEC.
+
+        Returns:
+            Number of entries written.
+        """
+        rows = self.db.execute("SELECT name, password FROM users").fetchall()
+        with self.batch():
+            self.db.executemany("UPDATE users SET password = ? WHERE name = ?",
+                                [(encode(decode(password)), name) for name, password in rows])
+        return len(rows)
+
+    def import_data(self, data):
+        """Import data exported by DataStore.export(), replacing existing entries of the same name.
+
+        Args:
+            data: Dict with the "users", "groups" and "tickets" of a data directory.
+        """
+        with self.batch():
+            channel_ids = {}
+            for group, d_group in data["groups"].items():
+                self.db.execute("DELETE FROM messages WHERE grp = ? AND user IS NULL", (group,))
+                self.db.execute("INSERT OR IGNORE INTO groups (name) VALUES (?)", (group,))
+                channel_ids[group] = [0]
+                for sender, _, stamp, body in d_group["messages"]:
+                    cursor = self.db.execute("INSERT INTO messages (grp, sender, body, time) VALUES (?, ?, ?, ?)",
+                                             (group, sender, body, stamp))
+                    channel_ids[group].append(cursor.lastrowid)
+            for user, d_user in data["users"].items():
+                self.remove_user(user)
+                ids = [0]
+                for sender, group, stamp, body in d_user["messages"]:
+                    cursor = self.db.execute("INSERT INTO messages (user, grp, sender, body, time) VALUES (?, ?, ?, ?, ?)",
+                                             (user, group, sender, body, stamp))
+                    ids.append(cursor.lastrowid)
+                self.db.execute("INSERT INTO users (name, password, last_read) VALUES (?, ?, ?)",
+                                (user, encode(d_user["password"]), ids[d_user["read"]]))
+                for group, (joined, read) in d_user["channels"].items():
+                    self.db.execute("INSERT INTO members (grp, user, joined, last_read) VALUES (?, ?, ?, ?)",
+                                    (group, user, channel_ids[group][joined], channel_ids[group][read]))
+            for user, stamp in data["tickets"].items():
+                self.set_ticket(user, stamp)
+            self._index_all()
+
+def convert_data():
+    """Rewrite the data of the store in the format of CODEC, reading pickled data as well."""
+    global CONVERTING
+    CONVERTING = True
+    try:
+        count = STORE.convert()
+    finally:
+        CONVERTING = False
+    store_codec()
+    print("Converted {} entries to the {} format.".format(count, CODEC))
+
+def stored_codec():
+    """Return the name of the codec recorded in the data directory.
+
+    Data directories of earlier versions have no record and hold pickled files.
+
+    Returns:
+        The name or None if the data directory does not exist or is empty.
+    """
+    try:
+        with open(DATA + "/" + CODEC_FILE) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return PickleCodec.name if os.path.isdir(DATA) and os.listdir(DATA) else None
+
+def store_codec():
+    """Record CODEC as the format of the data directory."""
+    DataStore._write(DATA + "/" + CODEC_FILE, (CODEC + "\n").encode())
+
+def choose_codec(codec, convert):
+    """Set CODEC to the chosen codec or the one recorded in the data directory.
+
+    Exits if the chosen codec is not the recorded one and the data is not converted, as the files
+    would be written in a mix of formats and the pickled ones refused.
+
+    Args:
+        codec: Name of the codec given with --codec, None to use the recorded one.
+        convert: The data is going to be converted to the chosen codec.
+    """
+    global CODEC
+    stored = stored_codec()
+    if stored is not None and stored not in CODECS:
+        sys.exit("{}: Unknown codec recorded in {}/{}.".format(stored, DATA, CODEC_FILE))
+    CODEC = codec or stored or PickleCodec.name
+    if stored is not None and CODEC != stored and not convert:
+        sys.exit("The data directory is in the {} format. Convert it with --codec {} --convert.".format(stored, CODEC))
+
+def open_store(backend):
+    """Return a new store for the given backend name ("pickle" or "sqlite")."""
+    if backend == "sqlite":
+        return SQLiteStore()
+    return DataStore()
+
+def migrate_to_sqlite():
+    """Import the pickled files of the data directory into the SQLite database."""
+    data = DataStore().export()
+    store = SQLiteStore()
+    store.import_data(data)
+    store.close()
+    print("Imported {} users and {} groups into {}/messenger.db.".format(len(data["users"]), len(data["groups"]), DATA))
+
+STORE = open_store(BACKEND)
+
+class CommandLock:
+    """Lock that serializes the commands of concurrent server sessions.
+
+    Commands release it while they wait for an answer of their client or for a password hash, so
+    other sessions are not stalled by them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._local.held = True
+        return self
+
+    def __exit__(self, *exc):
+        self._local.held = False
+        self._lock.release()
+
+    @contextlib.contextmanager
+    def released(self):
+        """Release the lock for the duration of the block if the current thread holds it."""
+        if not getattr(self._local, "held", False):
+            yield
+            return
+        self.__exit__()
+        try:
+            yield
+        finally:
+            self.__enter__()
+
+COMMAND_LOCK = CommandLock()
+
+def ask(prompt, secret=False):
+    """Read an answer from the user, e.g. a password.
+
+    In batch mode the answer is taken from ANSWERS instead, in server mode it is asked from the
+    client of the session.
+
+    Args:
+        prompt: Text to prompt the user with.
+        secret: Do not echo the answer (for passwords).
+
+    Raises:
+        EOFError: If ANSWERS holds no answer.
+    """
+    asker = getattr(LOCAL, "ask", None)
+    if asker is not None:
+        with COMMAND_LOCK.released():
+            return asker(prompt, secret)
+    if ANSWERS is not None:
+        answer = next(ANSWERS, None)
+        if answer is None:
+            raise EOFError("The script has no answer to '{}'.".format(prompt.strip()))
+        return answer
+    if secret:
+        return getpass.getpass(prompt)
+    return input(prompt)
+
+def hash_password(password, salt, algorithm="sha256", iterations=100000):
+    """Return the hex encoded PBKDF2 hash of a password.
+
+    Args:
+        password: Password in plain text.
+        salt: Random bytes to salt the hash with.
+        algorithm: Name of the hash function used by PBKDF2.
+        iterations: Number of PBKDF2 iterations.
+    """
+    return binascii.hexlify(hashlib.pbkdf2_hmac(algorithm, str.encode(password), salt, iterations))
+
+def new_password_entry(password, algorithm=None, iterations=None):
+    """Return a [hash, salt, algorithm, iterations] entry for a password with a new random salt.
+
+    Args:
+        password: Password in plain text.
+        algorithm: Name of the hash function, HASH_ALGORITHM by default.
+        iterations: Number of iterations, HASH_ITERATIONS by default.
+    """
+    algorithm = algorithm or HASH_ALGORITHM
+    iterations = iterations or HASH_ITERATIONS
+    salt = os.urandom(32)
+    return [hash_password(password, salt, algorithm, iterations), salt, algorithm, iterations]
+
+def hash_parameters(entry):
+    """Return the (salt, algorithm, iterations) of a password entry.
+
+    Entries of the form [hash, salt] were hashed with sha256 and 100000 iterations.
+    """
+    if len(entry) > 3:
+        return entry[1], entry[2], entry[3]
+    return entry[1], "sha256", 100000
+
+def wait(future):
+    """Return the result of a future, letting other server sessions run in the meantime."""
+    with COMMAND_LOCK.released():
+        return future.result()
+
+def hash_pool():
+    """Return the process pool that runs the password hashing, None if processes are not available.
+
+    The workers are started by a fork server (or spawned where there is none) instead of being
+    forked from this process, whose other threads may hold locks and whose client sockets would
+    stay open in the workers. main() creates the pool before any threads are started.
+    """
+    global HASH_POOL
+    if HASH_POOL is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        try:
+            HASH_POOL = concurrent.futures.ProcessPoolExecutor(HASH_WORKERS,
+                                                               mp_context=multiprocessing.get_context(method))
+        except (OSError, NotImplementedError):
+            HASH_POOL = False
+    return HASH_POOL or None
+
+def submit_hash(func, *args):
+    """Run a hashing function in the process pool.
+
+    Args:
+        func: Function to run, e.g. hash_password or new_password_entry.
+        args: Arguments of the function.
+
+    Returns:
+        Future of the result.
+    """
+    pool = hash_pool()
+    if pool is not None:
+        try:
+            return pool.submit(func, *args)
+        except RuntimeError:
+            pass
+    future = concurrent.futures.Future()
+    future.set_result(func(*args))
+    return future
+
+def verify_password(user, password, upgrade=True):
+    """Check the password of a user, hashing it in the process pool.
+
+    Entries hashed with a different algorithm or number of iterations than configured are
+    rehashed with the current settings when the password is correct.
+
+    Args:
+        user: Name of the user whose password is to be checked.
+        password: Password in plain text.
+        upgrade: Rehash outdated entries.
+
+    Returns:
+        True if the password is correct, False otherwise.
+    """
+    entry = STORE.password(user)
+    if entry is None:
+        return False
+    if wait(submit_hash(hash_password, password, *hash_parameters(entry))) != entry[0]:
+        return False
+    if upgrade and hash_parameters(entry)[1:] != (HASH_ALGORITHM, HASH_ITERATIONS):
+        STORE.set_password(user, wait(submit_hash(new_password_entry, password, HASH_ALGORITHM, HASH_ITERATIONS)))
+        STORE.commit()
+    return True
 
 def create_user(user):
     """Create a new user with hashed password.
 
     Args:
-        user: Name of the new user.
+        user: Name of the new user.
+
+    Raises:
+        Error if passwords do not match.
+    """
+    if user_exists(user):
+        print('A user with the name {} does already exist. Please choose a different username.'.format(user))
+    else:
+        password = ask('Password: ', secret=True)
+        password_check = ask('Repeat Password: ', secret=True)
+        if not password:
+            print('The password must not be empty. Try again.')
+            create_user(user)
+        elif password != password_check:
+            print('Passwords do not match. Try again.')
+            create_user(user)
+        else:
+            entry = wait(submit_hash(new_password_entry, password, HASH_ALGORITHM, HASH_ITERATIONS))
+            with STORE.batch():
+                STORE.add_user(user, entry)
+                if not group_exists("all"):
+                    create_group("all", [user])
+                else:
+                    add_members_to_group([user], "all")
+
+def delete_user(user):
+    """Delete a specified user.
+
+    Args:
+        user: Name of the user to be deleted.
+
+    Raises:
+        Error if no such user exists or the users password was wrong.
+    """
+    if not user_exists(user):
+        print("This user {} does not exist.".format(user))
+    else:
+        password = ask(user + "'s Password: ", secret=True)
+        if verify_password(user, password, upgrade=False):
+            with STORE.batch():
+                groups = get_groups_of_member(user)
+                STORE.remove_user(user)
+                for group in groups:
+                    if not get_group_members(group):
+                        STORE.remove_group(group)
+            print("User {} has been deleted.".format(user))
+        else:
+            print("Invalid Password")
+
+def delete_member_from_group(member, group):
+    """Delete a specified user from a specific group.
+
+    Args:
+        member: name of the user whose membership is to be deleted.
+        group: group from which the user is to be deleted.
+    """
+    if group_exists(group) and user_is_in_group(member, group):
+        with STORE.batch():
+            STORE.remove_member(group, member)
+            if not get_group_members(group):
+                STORE.remove_group(group)
+
+def delete_group(group, user):
+    """Delete specified group.
+
+    Args:
+        group: Group which is to be deleted.
+        user: User who is about to delete the group.
+
+    Raises:
+        Error if user is not authorized to delete the group or if the group does not exist.
+    """
+    if group_exists(group) and user_is_in_group(user, group) and group != "all":
+        with STORE.batch():
+            STORE.remove_group(group)
+        print("The group {} has been deleted.".format(group))
+    else:
+        print("You cannot delete the group {} (doesn't exist or you're not authorized).".format(group))
+
+def user_is_in_group(member, group):
+    """Check if specified user is member of a specific group.
+
+    Args:
+        user: User whose membership is to be checked.
+        group: Group to which the membership is to be checked.
+
+    Returns:
+        True if user is in group, False otherwise.
+    """
+    return member in STORE.group_members(group)
+
+def create_group(group, members):
+    """Create a new group with specified members.
+
+    Args:
+        group: Name of the new group.
+        members: List of members in this new group.
+
+    Raises:
+        Error if a group with the specified name does already exist or one specified member does not exist.
+    """
+    if group_exists(group):
+        print("A group with this name does already exist. Please choose a different group name.")
+    else:
+        existing_members = []
+        for member in members:
+            if user_exists(member):
+                if member not in existing_members:
+                    existing_members.append(member)
+            else:
+                print("User {0} not added: Does not exist. To create it type 'create user {0}'.".format(member))
+        with STORE.batch():
+            STORE.add_group(group, existing_members)
+
+def list_groups():
+    """Print out a list of the existing groups.
+
+    Raises:
+        Error if there are no groups yet.
+    """
+    groups = STORE.groups()
+    if groups:
+        for group in groups:
+            print(group)
+    else:
+        print("No groups")
+
+def group_exists(group):
+    """Check if specified group exists.
+
+    Args:
+        group: Name of the group whose existence is to be checked.
+
+    Returns:
+        True if group exists, False otherwise.
+    """
+    return STORE.group_exists(group)
+
+def get_group_members(group):
+    """Return a list of the members of a specific group.
+
+    Args:
+        group: Name of the group whose members are to be returned.
+    """
+    return STORE.group_members(group)
+
+def list_group_members(group):
+    """Print out the members of a specific group.
+
+    Args:
+        group: Name of the group whose members are to be printed.
+    """
+    members = get_group_members(group)
+    for member in members:
+        print(member)
+
+def list_groups_of_member(member):
+    """Print out the groups of a specified user.
+
+    Args:
+        member: Name of the user whose group memberships are to be printed.
+
+    Raises:
+        Error if user does not exist.
+    """
+    if user_exists(member):
+        for group in get_groups_of_member(member):
+            print(group)
+    else:
+        print("The user {} does not exist.".format(member))
+
+def get_groups_of_member(member):
+    """Return a list of groups of a specified user.
+
+    Args:
+        member: Name of the user whose group memberships are to be returned.
+    """
+    return STORE.groups_of(member)
+
+def add_members_to_group(members, group):
+    """Add specified users to a specific group.
+
+    Args:
+        members: List of members to be added to the group.
+        group: Name of the group to which the members are to be added.
+
+    Raises:
+        Error if user or group do not exist.
+    """
+    if group_exists(group):
+        current = set(get_group_members(group))
+        with STORE.batch():
+            for member in members:
+                if user_exists(member):
+                    if member not in current:
+                        STORE.add_member(group, member)
+                        current.add(member)
+                    else:
+                        print("{} is already a member of {}".format(member, group))
+                else:
+                    print("The user {} does not exist.".format(member))
+    else:
+        print("The group {} does not exist.".format(group))
+
+def read_user_file(file_name):
+    """Read the users to be provisioned from a CSV or JSON lines file.
+
+    CSV files need a header line. Both formats use the fields name, password (plain text) or
+    hash and salt (hex encoded), and groups (separated by spaces or semicolons in CSV files, a list
+    in JSON lines files).
+
+    Args:
+        file_name: Path and name of the file (*.jsonl/*.json for JSON lines, CSV otherwise).
+
+    Returns:
+        List of the rows, dicts with the fields of each user unless the file is malformed, see
+        check_user_row.
+    """
+    with open(file_name, newline='') as file:
+        if file_name.endswith((".jsonl", ".json")):
+            return [json.loads(line) for line in file if line.strip()]
+        return list(csv.DictReader(file))
+
+def check_user_row(row):
+    """Check the fields of a row of a user file and split its groups into a list.
+
+    Args:
+        row: Row read by read_user_file.
+
+    Returns:
+        Reason why the user cannot be imported, None if the row is valid.
+    """
+    if not isinstance(row, dict):
+        return "Not an object with the fields of a user."
+    for field in ["name", "password", "hash", "salt"]:
+        if row.get(field) is not None and not isinstance(row[field], str):
+            return "The {} is not a string.".format(field)
+    groups = row.get("groups") or []
+    if isinstance(groups, str):
+        groups = groups.replace(";", " ").split()
+    if not isinstance(groups, list) or not all(isinstance(group, str) and group.split() == [group]
+                                               for group in groups):
+        return "The groups are not a list of names."
+    row["groups"] = groups
+    if not row.get("password"):
+        if not (row.get("hash") and row.get("salt")):
+            return "No password or hash provided."
+        for field in ["hash", "salt"]:
+            try:
+                binascii.unhexlify(row[field])
+            except (binascii.Error, ValueError):
+                return "The {} is not hex encoded.".format(field)
+    return None
+
+def import_users(file_name):
+    """Create users and group memberships in bulk from a CSV or JSON lines file.
+
+    Plain text passwords are hashed in parallel on all CPU cores. All users are added to the group
+    'all' and to their listed groups, which are created if necessary. Everything is committed at
+    once, so each data file is written a single time.
+
+    Args:
+        file_name: Path and name of the file, see read_user_file for the format.
+
+    Raises:
+        Error if the file could not be found or read.
+    """
+    try:
+        rows = read_user_file(file_name)
+    except FileNotFoundError:
+        print("File was not found. Please make sure you typed it in the right way: /path/to/file/file_name")
+        return
+    except (ValueError, csv.Error) as err:
+        print("import: Could not read {}: {}".format(file_name, err))
+        return
+    users = []
+    seen = set()
+    skipped = 0
+    for number, row in enumerate(rows, 1):
+        error = check_user_row(row)
+        name = row.get("name") if isinstance(row, dict) else None
+        name = name.strip() if isinstance(name, str) else ""
+        if not name or len(name.split()) > 1 or name in seen or user_exists(name):
+            if error is not None:
+                print("Row {} not imported: {}".format(number, error))
+            skipped += 1
+        elif error is not None:
+            print("User {} not imported: {}".format(name, error))
+            skipped += 1
+        else:
+            seen.add(name)
+            row["name"] = name
+            users.append(row)
+    plain = [row["password"] for row in users if row.get("password")]
+    hash_new = functools.partial(new_password_entry, algorithm=HASH_ALGORITHM, iterations=HASH_ITERATIONS)
+    pool = hash_pool() if len(plain) > 1 else None
+    if pool is not None:
+        hashed = iter(pool.map(hash_new, plain, chunksize=max(1, len(plain) // (4 * (os.cpu_count() or 1)))))
+    else:
+        hashed = iter(map(hash_new, plain))
+    memberships = {"all": []}
+    with STORE.batch():
+        for row in users:
+            if row.get("password"):
+                entry = next(hashed)
+            else:
+                entry = [str.encode(row["hash"]), binascii.unhexlify(row["salt"])]
+            STORE.add_user(row["name"], entry)
+            memberships["all"].append(row["name"])
+            for group in row["groups"]:
+                memberships.setdefault(group, []).append(row["name"])
+        count = 0
+        for group, members in memberships.items():
+            if not members:
+                continue
+            if not group_exists(group):
+                STORE.add_group(group, [])
+            current = set(get_group_members(group))
+            for member in members:
+                if member not in current:
+                    STORE.add_member(group, member)
+                    current.add(member)
+                    count += 1
+    print("Imported {} users ({} skipped) with {} group memberships.".format(len(users), skipped, count))
+
+def tokenize_expression(exp):
+    """Split an expression into its numbers and the shape of the expression.
+
+    Args:
+        exp: Expression of numbers, '+', '-', '*', '/' and parentheses, e.g. 2*(1.5-.5e1).
+
+    Returns:
+        (shape, numbers): The shape is a tuple of the operators and parentheses with 'n' in place of
+        the numbers, so expressions that differ only in their numbers share it.
+
+    Raises:
+        ValueError if the expression contains other characters.
+    """
+    shape = []
+    numbers = []
+    position = 0
+    exp = exp.rstrip()
+    while position < len(exp):
+        match = EXPRESSION_TOKEN.match(exp, position)
+        if match is None:
+            raise ValueError("Invalid input. Only numbers, '+', '-', '*', '/' and parentheses allowed.")
+        number, operator = match.groups()
+        if number is not None:
+            shape.append("n")
+            numbers.append(float(number))
+        else:
+            shape.append(operator)
+        position = match.end()
+    return tuple(shape), tuple(numbers)
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE)
+def compile_shape(shape):
+    """Compile the shape of an expression, see tokenize_expression, into a function of its numbers.
+
+    The shape is parsed by recursive descent into nested functions applying the functions of the
+    operator module, so the function can also be called with NumPy arrays to evaluate many
+    expressions of the same shape at once.
+
+    Raises:
+        ValueError if the shape is not a valid expression.
+    """
+    tokens = list(shape) + [None]
+    position = 0
+    count = 0
+    binary = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+    unary = {"+": operator.pos, "-": operator.neg}
+
+    def chain(operand, operators):
+        # operand ((operator) operand)*, evaluated from left to right without nesting the calls.
+        nonlocal position
+        first = operand()
+        rest = []
+        while tokens[position] in operators:
+            position += 1
+            rest.append((binary[tokens[position - 1]], operand()))
+        if not rest:
+            return first
+
+        def evaluate(numbers):
+            value = first(numbers)
+            for apply, func in rest:
+                value = apply(value, func(numbers))
+            return value
+        return evaluate
+
+    def expression():
+        # expression := term (('+' | '-') term)*
+        return chain(term, ("+", "-"))
+
+    def term():
+        # term := factor (('*' | '/') factor)*
+        return chain(factor, ("*", "/"))
+
+    def factor():
+        # factor := ('+' | '-') factor | number | '(' expression ')'
+        nonlocal position, count
+        token = tokens[position]
+        position += 1
+        if token in unary:
+            apply, func = unary[token], factor()
+            return lambda numbers: apply(func(numbers))
+        if token == "(":
+            func = expression()
+            if tokens[position] != ")":
+                raise ValueError(invalid)
+            position += 1
+            return func
+        if token != "n":
+            raise ValueError(invalid)
+        count += 1
+        return operator.itemgetter(count - 1)
+
+    invalid = "Invalid input. An operand, operator or parenthesis is missing."
+    try:
+        evaluate = expression()
+    except (RecursionError, MemoryError):
+        raise ValueError("Invalid input. The expression is too long or nested too deeply.") from None
+    if tokens[position] is not None:
+        raise ValueError(invalid)
+    return lambda *numbers: evaluate(numbers)
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE)
+def compile_expression(exp):
+    """Return the compiled function of an expression and the numbers to call it with.
+
+    Raises:
+        ValueError if the expression is invalid.
+    """
+    shape, numbers = tokenize_expression(exp)
+    return compile_shape(shape), numbers
+
+def calc(exp):
+    """Calculate given expression and return the result.
+
+    Args:
+        exp: Expression of numbers, '+', '-', '*', '/' and parentheses, e.g. (a+b)*-x/2.
+
+    Returns:
+        The result as float or None if the expression is invalid. The error is printed then.
+    """
+    try:
+        func, numbers = compile_expression(exp)
+        return float(func(*numbers))
+    except ValueError as err:
+        print("calc: {}".format(err))
+    except ZeroDivisionError:
+        print("calc: Division by zero.")
+    return None
+
+def calc_all(expressions):
+    """Calculate many expressions, e.g. the lines of a file.
+
+    Expressions of the same shape are compiled once and, if NumPy is available, evaluated
+    together on arrays of their numbers.
+
+    Args:
+        expressions: List of expressions.
+
+    Returns:
+        List of the results: floats, or strings with the error for invalid expressions.
+    """
+    results = [None] * len(expressions)
+    groups = {}
+    for i, exp in enumerate(expressions):
+        try:
+            shape, numbers = tokenize_expression(exp)
+            groups.setdefault(shape, ([], []))
+            groups[shape][0].append(i)
+            groups[shape][1].append(numbers)
+        except ValueError as err:
+            results[i] = "calc: {}".format(err)
+    for shape, (indexes, rows) in groups.items():
+        try:
+            func = compile_shape(shape)
+        except ValueError as err:
+            for i in indexes:
+                results[i] = "calc: {}".format(err)
+            continue
+        if numpy is not None and len(rows) > 1:
+            try:
+                with numpy.errstate(all="ignore", divide="raise", invalid="raise"):
+                    values = func(*numpy.array(rows, dtype=float).T)
+                for i, value in zip(indexes, numpy.broadcast_to(values, len(rows)).tolist()):
+                    results[i] = value
+                continue
+            except FloatingPointError:
+                pass
+        for i, numbers in zip(indexes, rows):
+            try:
+                results[i] = float(func(*numbers))
+            except ZeroDivisionError:
+                results[i] = "calc: Division by zero."
+    return results
+
+def calc_file(file_name):
+    """Print the results of the expressions in a file, one per line, see calc_all.
+
+    Args:
+        file_name: Name of the file with an expression per line, '-' for stdin.
+    """
+    try:
+        if file_name == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(file_name) as file:
+                lines = file.read().splitlines()
+    except FileNotFoundError:
+        print("File was not found. Please make sure you typed it in the right way: /path/to/file/file_name")
+        return
+    sys.stdout.write("".join("{}\n".format(result) for result in calc_all(lines)))
+
+def std_input(exp):
+    """Print the result of an expression evaluated by the calc function.
+
+    Args:
+        exp: Expression, e.g. a number or (a+b)*x/2.
+    """
+    res = calc(exp)
+    if res is not None:
+        print(res)
+
+def say_hello(user):
+    """Greet the user.
+
+    Args:
+        user: User that is to be greeted.
+    """
+    if user:
+        print("Hello {}.".format(user))
+    else:
+        print("Hello.")
+
+def say_x(exp):
+    """Print out input.
+
+    Args:
+        exp: The input expression to be printed out.
+    """
+    print(exp)
+
+def file_options(args):
+    """Parse the arguments of 'print <file>' into the file name and keyword arguments of print_file.
+
+    Args:
+        args: List of the arguments, e.g. ['server.log', '--tail', '20', '--page'].
 
     Raises:
-        Error if passwords do not match.
+        getopt.GetoptError or ValueError if the arguments are invalid.
     """
-    if user_exists(user):
-        print('A user with the name {} does already exist. Please choose a different username.'.format(user))
-    else:
-        password = getpass.getpass('Password: ')
-        password_check = getpass.getpass('Repeat Password: ')
-        if password != password_check:
-            print('Passwords do not match. Try again.')
-            create_user(user)
+    opts, rest = getopt.gnu_getopt(args, "", ["head=", "tail=", "page"])
+    if len(rest) != 1:
+        raise ValueError("expected one file name" if not rest else "unexpected argument '{}'".format(rest[1]))
+    options = {}
+    for opt, arg in opts:
+        if opt == "--page":
+            options["page"] = True
         else:
-            salt = os.urandom(32)
-            hashed_password = binascii.hexlify(hashlib.pbkdf2_hmac('sha256', str.encode(password), salt, 100000))
-            d_pass = {}
-            try:
-                with open('{}/passes.txt'.format(DATA), 'rb') as file:
-                    d_pass = pickle.load(file)
-            except FileNotFoundError:
-                print("File does not exist. Will be created...")
-            d_pass[user] = [hashed_password, salt]
-            with open('{}/passes.txt'.format(DATA), 'wb') as file:
-                pickle.dump(d_pass, file)
-            with open('{}/{}.txt'.format(DATA, user), 'wb') as file:
-                d_user = {}
-                d_user["messages"] = []
-                d_user["groups"] = []
-                pickle.dump(d_user, file)
-            if not group_exists("all"):
-                create_group("all", [user])
-            else:
-                add_members_to_group([user], "all")
+            options[opt[2:]] = int(arg)
+            if options[opt[2:]] < 0:
+                raise ValueError("the number of lines must not be negative")
+    if "head" in options and "tail" in options:
+        raise ValueError("--head and --tail cannot be combined")
+    return rest[0], options
 
-def delete_user(user):
-    """Delete a specified user.
+def tail_offset(file, count):
+    """Return the offset of the last <count> lines of a file, searching backwards from its end.
+
+    The file is memory-mapped, so only the pages holding the last lines are read.
 
     Args:
-        user: Name of the user to be deleted.
+        file: File opened in binary mode.
+        count: Number of lines.
+
+    Returns:
+        The offset or None if the file cannot be mapped, e.g. a pipe.
+    """
+    status = os.fstat(file.fileno())
+    if not stat.S_ISREG(status.st_mode):
+        return None
+    if not status.st_size or not count:
+        return status.st_size
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # A newline at the end terminates the last line, it does not start another one.
+        position = status.st_size - (data[-1] == ord("\n"))
+        for _ in range(count):
+            position = data.rfind(b"\n", 0, position)
+            if position < 0:
+                return 0
+        return position + 1
+
+def page_lines(lines, size=None):
+    """Print lines, a page of <size> lines at a time if given.
+
+    The next page is only read when the user asks for it.
+
+    Args:
+        lines: Iterable of the lines.
+        size: Number of lines per page, None to print all lines without asking.
+
+    Returns:
+        The last line printed, "" if there was none.
+    """
+    last = ""
+    for number, line in enumerate(lines):
+        if size and number and number % size == 0:
+            if ask("--More-- (Enter for the next page, q to quit) ").strip().lower() in QUITS:
+                break
+        sys.stdout.write(line)
+        last = line
+    return last
+
+def print_file(file_name, head=None, tail=None, page=False):
+    """Print out the contents of a specified file.
+
+    The file is streamed in blocks of READ_BLOCK bytes, so even huge files are printed in constant
+    memory and without delay.
+
+    Args:
+        file_name: Path and name of the file to be printed.
+        head: Print only the first <head> lines.
+        tail: Print only the last <tail> lines, found without reading the file before them.
+        page: Print a page of lines at a time, reading the next one only when asked for it.
+    """
+    try:
+        file = open(file_name, 'rb')
+    except FileNotFoundError:
+        print("File was not found. Please make sure you typed it in the right way: /path/to/file/file_name")
+        return
+    except OSError as err:
+        print("{}: {}".format(file_name, err.strerror))
+        return
+    with file:
+        offset = None if tail is None else tail_offset(file, tail)
+        if offset is not None:
+            file.seek(offset)
+        text = io.TextIOWrapper(file, errors="replace")
+        if head is None and tail is None and not page:
+            for block in iter(functools.partial(text.read, READ_BLOCK), ""):
+                sys.stdout.write(block)
+            # Like print, end with a newline.
+            print()
+            return
+        lines = text
+        if tail is not None and offset is None:
+            lines = collections.deque(text, maxlen=tail)
+        if head is not None:
+            lines = itertools.islice(lines, head)
+        last = page_lines(lines, max(1, shutil.get_terminal_size().lines - 1) if page else None)
+        if last and not last.endswith("\n"):
+            print()
+
+def list_users():
+    """Print out a list of the existing users."""
+    for user in STORE.users():
+        print(user)
+
+def get_users():
+    """Return a list of the existing users."""
+    return STORE.users()
+
+def login(user, session=None):
+    """Login as a specific user.
+
+    Args:
+        user: Name of the user to be logged in as.
+        session: Session the user logs in to. Remote sessions only accept their own tickets.
 
     Raises:
-        Error if no such user exists or the users password was wrong.
+        Error if password is not valid.
     """
+    is_logged_in = False
+    stop = False
     if not user_exists(user):
-        print("This user {} does not exist.".format(user))
-    else:
-        password = getpass.getpass(user + "'s Password: ")
-        try:
-            with open('{}/passes.txt'.format(DATA), 'rb') as file:
-                d_pass = pickle.load(file)
-        except FileNotFoundError:
-            print("No such user exists.")
-        real_password = d_pass[user][0]
-        salt = d_pass[user][1]
-        hashed_password = binascii.hexlify(hashlib.pbkdf2_hmac('sha256', str.encode(password), salt, 100000))
-        if hashed_password == real_password:
-            groups = get_groups_of_member(user)
-            if groups:
-                for group in groups:
-                    delete_member_from_group(user, group)
-            d_pass.pop(user, None)
-            with open(DATA + '/passes.txt', 'wb') as file:
-                pickle.dump(d_pass, file)
-            os.remove("{}/{}.txt".format(DATA, user))
-            print("User {} has been deleted.".format(user))
+        print("The user {} does not exist. Do you want to create it?".format(user))
+        answer = ask("[y/n]: ")
+        if answer == "y":
+            create_user(user)
+            print("Logging in as user " + user)
         else:
-            print("Invalid Password")
+            stop = True
+    if not stop:
+        if not check_ticket(user, session):
+            password = ask('Password: ', secret=True)
+            if verify_password(user, password):
+                print(user + " logged in.")
+                print_new_messages(user)
+                update_ticket(user, session)
+                is_logged_in = True
+            else:
+                print("Invalid Password")
+        else:
+            is_logged_in = True
+            print(user + " logged in.")
+            print_new_messages(user)
+    return is_logged_in
 
-def delete_member_from_group(member, group):
-    """Delete a specified user from a specific group.
+def logout(user, session=None):
+    """Logout specific user.
 
     Args:
-        member: name of the user whose membership is to be deleted.
-        group: group from which the user is to be deleted.
+        user: Name of the user to be logged out.
+        session: Session the user logs out of.
     """
-    if group_exists(group) and user_is_in_group(member, group):
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        d_group[group].remove(member)
-        with open('{}/groups.txt'.format(DATA), 'wb') as file:
-            pickle.dump(d_group, file)
-        with open('{}/{}.txt'.format(DATA, member), 'rb') as file:
-            d_user = pickle.load(file)
-        d_user["groups"].remove(group)
-        with open('{}/{}.txt'.format(DATA, member), 'wb') as file:
-            pickle.dump(d_user, file)
-        if not get_group_members(group):
-            with open('{}/groups.txt'.format(DATA), 'rb') as file:
-                d_group = pickle.load(file)
-            d_group.pop(group, None)
-            with open('{}/groups.txt'.format(DATA), 'wb') as file:
-                pickle.dump(d_group, file)
+    if session is not None and session.remote:
+        session.tickets.pop(user, None)
+    elif user_exists(user):
+        STORE.drop_ticket(user)
+        STORE.commit()
 
-def delete_group(group, user):
-    """Delete specified group.
+def update_ticket(user, session=None):
+    """Update ticket of the user after login.
+
+    The tickets of remote sessions are kept in the session, so they do not let other clients of
+    the server log in without a password.
 
     Args:
-        group: Group which is to be deleted.
-        user: User who is about to delete the group.
+        user: Name of the user whose ticket is to be updated.
+        session: Session the user logged in to.
+    """
+    if session is not None and session.remote:
+        session.tickets[user] = time.time()
+        return
+    STORE.set_ticket(user, time.time())
+    STORE.commit()
 
-    Raises:
-        Error if user is not authorized to delete the group or if the group does not exist.
+def check_ticket(user, session=None):
+    """Check if the current ticket is still valid (less than TICKET_TTL seconds old).
+
+    Args:
+        user: Name of the user whose ticket is to be checked.
+        session: Session the user logs in to. Remote sessions only accept their own tickets.
+
+    Returns:
+        True if ticket is still valid, False otherwise.
     """
-    if group_exists(group) and user_is_in_group(user, group) and group != "all":
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        for member in d_group[group]:
-            delete_member_from_group(member, group)
-        d_group.pop(group, None)
-        with open('{}/groups.txt'.format(DATA), 'wb') as file:
-            pickle.dump(d_group, file)
-        print("The group {} has been deleted.".format(group))
+    ticket = False
+    if session is not None and session.remote:
+        stamp = session.tickets.get(user)
     else:
-        print("You cannot delete the group {} (doesn't exist or you're not authorized).".format(group))
+        stamp = STORE.ticket(user)
+    if stamp is not None:
+        if time.time() - stamp < TICKET_TTL:
+            ticket = True
+    return ticket
 
-def user_is_in_group(member, group):
-    """Check if specified user is member of a specific group.
+def user_exists(user):
+    """Check if the specified user exists.
 
     Args:
-        user: User whose membership is to be checked.
-        group: Group to which the membership is to be checked.
+        user: Name of the user whose existence is to be checked.
 
     Returns:
-        True if user is in group, False otherwise.
+        True if user exists, False otherwise.
     """
-    res = False
-    if group_exists(group):
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        if member in d_group[group]:
-            res = True
-    return res
+    return STORE.user_exists(user)
 
-def create_group(group, members):
-    """Create a new group with specified members.
+def send_message(sender, recipient, msg, to_group=False):
+    """Send message to specified user or group.
+
+    If a user and a group share the same name, the message goes to the user unless to_group is set.
 
     Args:
-        group: Name of the new group.
-        members: List of members in this new group.
+        sender: Name of the user who sends the message.
+        recipient: Name of the recipient (user or group).
+        msg: Content of the message.
+        to_group: Send to the group <recipient> even if a user with that name exists.
 
     Raises:
-        Error if a group with the specified name does already exist or one specified member does not exist.
+        Error if sender or recipient do not exist.
     """
-    if group_exists(group):
-        print("A group with this name does already exist. Please choose a different group name.")
+    if not user_exists(sender):
+        print("Recipient or sender does not exist.")
+    elif not to_group and user_exists(recipient):
+        STORE.append_message(recipient, Message(sender, recipient, msg))
+        if STORE.commit():
+            print("The message could not be delivered to {}.".format(recipient))
+        else:
+            notify([recipient])
+    elif group_exists(recipient):
+        send_group_message(sender, recipient, msg)
     else:
-        existing_members = []
-        for member in members:
-            if user_exists(member):
-                existing_members.append(member)
-                with open('{}/{}.txt'.format(DATA, member), 'rb') as file:
-                    d_user = pickle.load(file)
-                d_user["groups"].append(group)
-                with open('{}/{}.txt'.format(DATA, member), 'wb') as file:
-                    pickle.dump(d_user, file)
-            else:
-                print("User {0} not added: Does not exist. To create it type 'create user {0}'.".format(member))
-        try:
-            with open('{}/groups.txt'.format(DATA), 'rb') as file:
-                d_group = pickle.load(file)
-        except FileNotFoundError:
-            print("Group file does not exist yet. Will be created...")
-            d_group = {}
-        d_group[group] = existing_members
-        with open('{}/groups.txt'.format(DATA), 'wb') as file:
-            pickle.dump(d_group, file)
+        print("Recipient or sender does not exist.")
 
-def list_groups():
-    """Print out a list of the existing groups.
+def send_group_message(sender, group, msg):
+    """Deliver a message to all members of a group at once.
+
+    The message is appended once to the channel of the group, from which the members read it.
+
+    Args:
+        sender: Name of the user who sends the message. Must exist.
+        group: Name of the group the message is sent to.
+        msg: Content of the message.
+    """
+    STORE.append_channel(group, Message(sender, None, msg, group=group))
+    if STORE.commit():
+        print("The message could not be delivered to the group {}.".format(group))
+    else:
+        notify(get_group_members(group))
+
+def notify(users):
+    """Tell the registered listeners (e.g. the server) that users received new messages."""
+    for listener in LISTENERS:
+        listener(users)
+
+def print_messages(user, last=None, sender=None, since=None, archive=False):
+    """Print the messages of the specified user.
+
+    The messages are printed as they are read, so large mailboxes are printed in constant memory.
+
+    Args:
+        user: Name of the user whose messages are to be printed.
+        last: Only print the last <last> messages.
+        sender: Only print the messages of this sender.
+        since: Only print the messages sent at or after this time (seconds since the epoch).
+        archive: Also print the archived messages.
 
     Raises:
-        Error if there are no groups yet.
+        Error if user does not exist.
     """
-    try:
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        for group in d_group:
-            print(group)
-    except FileNotFoundError:
-        print("No groups")
+    if user_exists(user):
+        empty = True
+        for message in iter_messages(user, last, sender, since, archive):
+            print(message)
+            empty = False
+        if empty:
+            print("No messages.")
+    else:
+        print("User {} does not exist.".format(user))
 
-def group_exists(group):
-    """Check if specified group exists.
+def iter_messages(user, last=None, sender=None, since=None, archive=False):
+    """Yield the messages of a user in the order of their time, reading only the needed records.
 
     Args:
-        group: Name of the group whose existence is to be checked.
+        user: Name of the user whose messages are to be yielded.
+        last: Only yield the last <last> messages. They are read backwards from the latest one.
+        sender: Only yield the messages of this sender.
+        since: Only yield the messages sent at or after this time (seconds since the epoch).
+        archive: Also yield the archived messages, decompressing them on the fly.
+    """
+    if last is None:
+        yield from STORE.iter_messages(user, sender, since, archive=archive)
+    else:
+        messages = STORE.iter_messages(user, sender, since, reverse=True, archive=archive)
+        yield from reversed(list(itertools.islice(messages, last)))
 
-    Returns:
-        True if group exists, False otherwise.
+def message_filters(args):
+    """Parse the options of 'print messages' into keyword arguments of print_messages.
+
+    Args:
+        args: List of the options, e.g. ['--last', '10', '--from', 'alice', '--since', '2h', '--archive'].
+
+    Raises:
+        getopt.GetoptError or ValueError if the options are invalid.
+    """
+    opts, rest = getopt.getopt(args, "", ["last=", "from=", "since=", "archive"])
+    if rest:
+        raise ValueError("unexpected argument '{}'".format(rest[0]))
+    filters = {}
+    for opt, arg in opts:
+        if opt == "--last":
+            filters["last"] = int(arg)
+            if filters["last"] < 0:
+                raise ValueError("--last must not be negative")
+        elif opt == "--from":
+            filters["sender"] = arg
+        elif opt == "--archive":
+            filters["archive"] = True
+        else:
+            filters["since"] = parse_time(arg)
+    return filters
+
+def parse_time(text):
+    """Return the time given as ISO date (2024-05-01, 2024-05-01T12:00) or age (30s, 15m, 2h, 7d).
+
+    Raises:
+        ValueError if the time cannot be parsed.
     """
-    res = False
     try:
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        if group in d_group:
-            res = True
-    except FileNotFoundError:
-        res = False
-    return res
+        return time.time() - parse_age(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
 
-def get_group_members(group):
-    """Return a list of the members of a specific group.
+def parse_age(text):
+    """Return the number of seconds of an age like 30s, 15m, 2h or 7d.
+
+    Raises:
+        ValueError if the age cannot be parsed.
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", text)
+    if not match:
+        raise ValueError("invalid age '{}'".format(text))
+    return float(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+def search_messages(user, text):
+    """Print the messages of a user containing all words of a text, looked up in the search index.
+
+    Args:
+        user: Name of the user whose messages are to be searched.
+        text: Words to search for. Case and punctuation are ignored.
+    """
+    messages = STORE.search(user, index_terms(text))
+    for message in messages:
+        print(message)
+    if not messages:
+        print("No messages found.")
+
+def compact_mailbox(user):
+    """Move the old read messages of a user to a compressed archive, see MAX_MESSAGES and MAX_AGE.
+
+    Args:
+        user: Name of the user whose mailbox is to be compacted.
+    """
+    if user_exists(user):
+        count = STORE.compact(user, MAX_MESSAGES, MAX_AGE)
+        print("Archived {} messages of {}.".format(count, user))
+    else:
+        print("User {} does not exist.".format(user))
+
+def compact_mailboxes():
+    """Compact the mailboxes of all users."""
+    for user in STORE.users():
+        compact_mailbox(user)
+
+def print_new_messages(user):
+    """Print newly received messages since last login.
+
+    Args:
+        user: Name of the user whose messages are to be printed.
+    """
+    messages = fetch_new_messages(user)
+    for msg in messages:
+        print(msg)
+    if not messages:
+        print("No new messages.")
+
+def fetch_new_messages(user):
+    """Return the newly received messages of a user and mark them as read.
+
+    Args:
+        user: Name of the user whose messages are to be returned.
+    """
+    new, end = STORE.new_messages(user)
+    group_messages, ends = STORE.channel_messages(user, unread=True)
+    new.extend(group_messages)
+    with STORE.batch():
+        STORE.mark_read(user, end)
+        STORE.mark_channels_read(user, ends)
+    return [str(message) for message in sorted(new, key=lambda message: message.time)]
+
+def parse_address(address):
+    """Split a server address into a (host, port) tuple for TCP or return it as Unix socket path.
+
+    Args:
+        address: Address of the form <host>:<port> or the path of a Unix socket.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and "/" not in address:
+        return host or "localhost", int(port)
+    return address
+
+class ThreadOutput:
+    """Stand-in for sys.stdout that sends the output of a server session thread to its client."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        """Write text to the client of the current thread, or to the wrapped stream."""
+        return (getattr(LOCAL, "output", None) or self.stream).write(text)
+
+    def flush(self):
+        """Flush the wrapped stream."""
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Connection:
+    """Client connection of the server, running its commands in a session of its own.
+
+    Lines sent to the client consist of a type and a JSON encoded text: 'o' output, '?' question,
+    '*' secret question, '.' ready for the next command (with the prompt), '!' pushed messages
+    and 'q' end of the session. The client sends commands and answers as plain lines.
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.session = Session(server.script, remote=True)
+        self.commands = asyncio.Queue()
+        self.answer = None
+
+    def send(self, kind, text=""):
+        """Send a line to the client. Must be called in the event loop.
+
+        A client that lets more than SERVER_OUTPUT_LIMIT bytes pile up unread is disconnected, so
+        it can neither make the server buffer unlimited output nor stall the other sessions.
+        """
+        if self.writer.is_closing():
+            return
+        self.writer.write("{} {}\n".format(kind, json.dumps(text)).encode())
+        if self.writer.transport.get_write_buffer_size() > SERVER_OUTPUT_LIMIT:
+            self.writer.transport.abort()
+
+    def write(self, text):
+        """Send output of a command to the client. Called from the worker threads."""
+        self.loop.call_soon_threadsafe(self.send, "o", text)
+
+    def ask(self, prompt, secret):
+        """Ask the client for an answer and wait for it. Called from the worker threads."""
+        return asyncio.run_coroutine_threadsafe(self._ask(prompt, secret), self.loop).result()
+
+    async def _ask(self, prompt, secret):
+        self.answer = self.loop.create_future()
+        self.send("*" if secret else "?", prompt)
+        return await self.answer
+
+    def run(self, command):
+        """Run a command of the client in its session. Called from the worker threads."""
+        LOCAL.output = self
+        LOCAL.ask = self.ask
+        try:
+            with COMMAND_LOCK:
+                return run_command(self.session, command)
+        except Exception as err:  # pylint: disable=broad-except
+            print("{}: {}".format(type(err).__name__, err))
+            return True
+        finally:
+            LOCAL.output = None
+            LOCAL.ask = None
+
+    async def handle(self):
+        """Read the lines of the client until it disconnects."""
+        worker = asyncio.ensure_future(self.work())
+        self.send("o", "Welcome to the messenger. Type 'quit' to exit and 'help' for more information about the usage.\n")
+        self.send(".", self.session.prompt)
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors="replace").rstrip("\r\n")
+                if self.answer is not None and not self.answer.done():
+                    self.answer.set_result(line)
+                else:
+                    self.commands.put_nowait(line)
+        finally:
+            worker.cancel()
+            if self.answer is not None and not self.answer.done():
+                self.answer.set_result("")
+            self.server.forget(self)
+            self.writer.close()
+
+    async def work(self):
+        """Run the commands of the client one after another until it disconnects."""
+        try:
+            while True:
+                command = await self.commands.get()
+                running = await self.loop.run_in_executor(self.server.pool, self.run, command.strip())
+                self.server.update(self)
+                if not running:
+                    self.send("q")
+                    await self.writer.drain()
+                    self.writer.close()
+                    return
+                self.send(".", self.session.prompt)
+                await self.writer.drain()
+        except ConnectionError:
+            return
+
+class Server:
+    """Messenger server that owns the store and serves many client sessions from one process.
+
+    New messages are pushed to the connected sessions of their recipients right away.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.pool = concurrent.futures.ThreadPoolExecutor(SERVER_WORKERS)
+        self.users = {}
+        self.loop = None
+
+    def update(self, connection):
+        """Register the connection under the user currently logged in to its session."""
+        self.forget(connection)
+        if connection.session.user:
+            self.users.setdefault(connection.session.user, set()).add(connection)
+
+    def forget(self, connection):
+        """Remove the connection from the user registry."""
+        for connections in self.users.values():
+            connections.discard(connection)
+
+    def notify(self, users):
+        """Push the new messages of users with open sessions. Called from the worker threads."""
+        for user in set(users):
+            if self.users.get(user):
+                self.loop.call_soon_threadsafe(self.loop.run_in_executor, self.pool, self.push, user)
+
+    def push(self, user):
+        """Send the new messages of a user to all its sessions. Called from the worker threads."""
+        with COMMAND_LOCK:
+            connections = list(self.users.get(user, ()))
+            messages = fetch_new_messages(user) if connections else []
+        for connection in connections:
+            for msg in messages:
+                self.loop.call_soon_threadsafe(connection.send, "!", msg)
+
+    async def serve(self, address):
+        """Accept connections on a TCP address (host, port) or a Unix socket path until cancelled."""
+        self.loop = asyncio.get_running_loop()
+        LISTENERS.append(self.notify)
+        sys.stdout = ThreadOutput(sys.stdout)
+
+        async def accept(reader, writer):
+            await Connection(self, reader, writer).handle()
+
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(accept, *address)
+        else:
+            server = await asyncio.start_unix_server(accept, address)
+        print("Serving on {}. Press Ctrl+C to stop.".format(address))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            LISTENERS.remove(self.notify)
+            sys.stdout = sys.stdout.stream
+            if not isinstance(address, tuple):
+                rm_file(address)
+
+def run_client(address):
+    """Connect to a messenger server and run its command line.
 
     Args:
-        group: Name of the group whose members are to be returned.
+        address: (host, port) tuple or Unix socket path of the server.
     """
-    members = []
-    if group_exists(group):
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        members = d_group[group]
-    return members
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    file = sock.makefile('rw', encoding='utf-8', newline='\n')
+    events = queue.Queue()
+    state = {"prompt": None}
 
-def list_group_members(group):
-    """Print out the members of a specific group.
+    def receive():
+        for line in file:
+            kind, _, text = line.rstrip("\n").partition(" ")
+            text = json.loads(text) if text else ""
+            if kind == "o":
+                print(text, end="", flush=True)
+            elif kind == "!":
+                prompt = state["prompt"]
+                print("\r" + text if prompt is not None else text)
+                if prompt is not None:
+                    print(prompt, end="", flush=True)
+            else:
+                events.put((kind, text))
+        events.put(("q", ""))
 
-    Args:
-        group: Name of the group whose members are to be printed.
-    """
-    members = get_group_members(group)
-    for member in members:
-        print(member)
+    threading.Thread(target=receive, daemon=True).start()
+    while True:
+        kind, text = events.get()
+        if kind == "q":
+            break
+        try:
+            if kind == "*":
+                answer = getpass.getpass(text)
+            else:
+                state["prompt"] = text if kind == "." else None
+                answer = input(text)
+        except EOFError:
+            answer = "quit" if kind == "." else ""
+        state["prompt"] = None
+        file.write(answer + "\n")
+        file.flush()
+    sock.close()
 
-def list_groups_of_member(member):
-    """Print out the groups of a specified user.
+def start_profile(path):
+    """Start profiling the process, writing the statistics to a file on exit, see write_profile.
 
     Args:
-        member: Name of the user whose group memberships are to be printed.
-
-    Raises:
-        Error if user does not exist.
+        path: File to write to. The Prometheus text format is written to files ending in .prom and
+            nothing is profiled then.
     """
-    if user_exists(member):
-        for group in get_groups_of_member(member):
-            print(group)
+    global PROFILE
+    if not path.endswith(".prom"):
+        PROFILE = cProfile.Profile()
+        PROFILE.enable()
+    atexit.register(write_profile, path)
+
+def write_profile(path):
+    """Write the statistics and the cProfile results, if any, to a file, see start_profile."""
+    if PROFILE is not None:
+        PROFILE.disable()
+        output = io.StringIO()
+        output.write(STATS.report())
+        output.write("\nProfile:\n")
+        pstats.Stats(PROFILE, stream=output).sort_stats("cumulative").print_stats(50)
+        data = output.getvalue()
     else:
-        print("The user {} does not exist.".format(member))
+        data = STATS.prometheus()
+    try:
+        DataStore._write(path, data.encode())
+    except OSError as err:
+        print("{}: The profile could not be written: {}".format(path, err), file=sys.stderr)
 
-def get_groups_of_member(member):
-    """Return a list of groups of a specified user.
+class Inotify:
+    """Minimal binding of the Linux inotify API through ctypes."""
 
-    Args:
-        member: Name of the user whose group memberships are to be returned.
-    """
-    groups = []
-    if user_exists(member):
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self.fd = fd
+
+    @classmethod
+    def open(cls):
+        """Return a new inotify instance or None if inotify is not available, e.g. not on Linux."""
         try:
-            with open('{}/{}.txt'.format(DATA, member), 'rb') as file:
-                d_user = pickle.load(file)
-            if "groups" in d_user:
-                groups = d_user["groups"]
-        except FileNotFoundError:
-            groups = []
-    return groups
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (ImportError, OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
 
-def add_members_to_group(members, group):
-    """Add specified users to a specific group.
+    def add(self, path):
+        """Watch a directory for files being written, created or moved into it. Returns False on failure."""
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        return self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask) >= 0
 
-    Args:
-        members: List of members to be added to the group.
-        group: Name of the group to which the members are to be added.
+    def wait(self, timeout):
+        """Wait up to <timeout> seconds for events and return the names of the files they concern."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        names = []
+        if not ready:
+            return names
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            length = self.EVENT.unpack_from(data, offset)[3]
+            offset += self.EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+            offset += length
+        return names
 
-    Raises:
-        Error if user or group do not exist.
-    """
-    if group_exists(group):
-        with open('{}/groups.txt'.format(DATA), 'rb') as file:
-            d_group = pickle.load(file)
-        for member in members:
-            if user_exists(member):
-                if member not in d_group[group]:
-                    d_group[group].append(member)
-                    with open('{}/{}.txt'.format(DATA, member), 'rb') as file:
-                        d_user = pickle.load(file)
-                    if "groups" not in d_user:
-                        d_user["groups"] = []
-                    d_user["groups"].append(group)
-                    with open('{}/{}.txt'.format(DATA, member), 'wb') as file:
-                        pickle.dump(d_user, file)
-                else:
-                    print("{} is already a member of {}".format(member, group))
-            else:
-                print("The user {} does not exist.".format(member))
-        with open('{}/groups.txt'.format(DATA), 'wb') as file:
-            pickle.dump(d_group, file)
-    else:
-        print("The group {} does not exist.".format(group))
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
 
-def calc(exp):
-    """Calculate given expression and return the result.
+class Watcher:
+    """Prints the new messages of the logged in user of a command line session as they arrive.
 
-    Args:
-        exp: Expression as string of the form a*x+b.
+    A thread waits for changes in the data directory through inotify or, where it is not available,
+    polls for them every WATCH_POLL_MIN seconds, backing off exponentially to WATCH_POLL_MAX while
+    nothing changes. A change is only acted on if the watch token of the store changed, see
+    DataStore.watch_token, and then only the new records are read. Messages are printed above the
+    prompt while the user is typing a command. While a command runs they are held back until it
+    ends, so they never end up in the middle of its output or of a password prompt.
     """
-    res = 0
-    invalid = False
-    adds = exp.split("+")
-    for add in adds:
-        mults = add.split("*")
-        add = 1
-        for mult in mults:
-            if mult.isdigit():
-                add = add*float(mult)
+
+    def __init__(self, session):
+        self.session = session
+        self.prompting = True
+        self.pending = False
+        self._token = None
+        self._stop = threading.Event()
+        self._inotify = Inotify.open()
+        if self._inotify is not None and not self._inotify.add(DATA):
+            self._inotify.close()
+            self._inotify = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = WATCH_POLL_MIN
+        while not self._stop.is_set():
+            if self._inotify is not None:
+                self._inotify.wait(WATCH_POLL_MAX)
+                self._check()
+            elif self._check():
+                delay = WATCH_POLL_MIN
             else:
-                print("calc: Invalid input. Only numbers, '+' and '*' allowed.")
-                invalid = True
-        res += add
-    if invalid:
-        res = None
-    return res
+                delay = min(delay * 2, WATCH_POLL_MAX)
+            if self._inotify is None:
+                self._stop.wait(delay)
 
-def std_input(exp):
-    """Check if the input is a number or an expression to be evaluated by the calc function.
+    def _check(self):
+        """Deliver the new messages if the watch token changed. Returns True if it did."""
+        with COMMAND_LOCK:
+            user = self.session.user
+            token = (user, STORE.watch_token(user)) if user and user_exists(user) else None
+            if token == self._token:
+                return False
+            self._token = token
+            if token is None:
+                return False
+            if self.prompting:
+                self._deliver(redisplay=True)
+            else:
+                self.pending = True
+            return True
 
-    Args:
-        exp: Expression that is either a number or of the form a*x+b.
+    def _deliver(self, redisplay):
+        self.pending = False
+        messages = fetch_new_messages(self.session.user)
+        if not messages:
+            return
+        text = "".join(message + "\n" for message in messages)
+        if redisplay:
+            # Print the messages over the prompt, then the prompt again with what was typed so far.
+            line = readline.get_line_buffer() if readline is not None else ""
+            text = "\r\x1b[K" + text + self.session.prompt + line
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    @contextlib.contextmanager
+    def running(self):
+        """Hold back the new messages while the block runs a command and print them after it."""
+        with COMMAND_LOCK:
+            self.prompting = False
+            try:
+                yield
+            finally:
+                if self.pending and self.session.user:
+                    self._deliver(redisplay=False)
+                self.prompting = True
+
+    def stop(self):
+        """Stop watching."""
+        self._stop.set()
+        self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+
+def clean_up():
+    """Remove the files of the store if it has no users or groups left.
+
+    The data directory itself is only removed if nothing else, e.g. the data of the other
+    backend, is left in it.
     """
-    try:
-        res = float(exp)
-        print(res)
-    except ValueError:
-        res = calc(exp)
-        if res:
-            print(res)
+    if not get_users() and not STORE.groups():
+        STORE.remove()
+        if os.path.isdir(DATA) and os.listdir(DATA) == [CODEC_FILE]:
+            rm_file(DATA + "/" + CODEC_FILE)
+        if os.path.isdir(DATA) and not os.listdir(DATA):
+            os.rmdir(DATA)
 
-def say_hello(user):
-    """Greet the user.
+def rm_file(file_name):
+    """Check if file exists and if so remove it.
 
     Args:
-        user: User that is to be greeted.
+        file_name: Path and name of the file to be deleted.
     """
-    if user:
-        print("Hello {}.".format(user))
-    else:
-        print("Hello.")
+    if os.path.isfile(file_name):
+        os.remove(file_name)
 
-def say_x(exp):
-    """Print out input.
+class Session:
+    """State of a command line session: the logged in user and the prompt.
 
-    Args:
-        exp: The input expression to be printed out.
+    Attributes:
+        script: Name of the program, shown in the prompt.
+        user: Name of the logged in user, "" if none.
+        remote: True for the sessions of server clients. They cannot read the files of the server
+            host and only accept login tickets of their own.
+        tickets: Login times of the users logged in to a remote session, see update_ticket.
     """
-    print(exp)
 
-def print_file(file_name):
-    """Print out the contents of a specified file.
+    def __init__(self, script, user="", remote=False):
+        self.script = script
+        self.user = user
+        self.remote = remote
+        self.tickets = {}
 
-    Args:
-        file_name: Path and name of the file to be printed.
+    @property
+    def prompt(self):
+        """Prompt of the command line, showing the logged in user."""
+        if self.user:
+            return "{}:{}# ".format(self.user, self.script)
+        return self.script + "# "
 
-    Raises:
-        Error if file could not be found.
+class Script:
+    """Lines of a batch script: commands, each followed by the answers to its questions.
+
+    Answer lines start with ANSWER_PREFIX, e.g. 'answer: secret'. Answers are only taken from the
+    lines directly following the command, so a command whose answer is missing fails instead of
+    taking the next command as its answer, and answer lines that are not asked for are skipped
+    instead of being run as commands.
     """
-    try:
-        with open(file_name) as file:
-            read_data = file.read()
-            print(read_data)
-    except FileNotFoundError:
-        print("File was not found. Please make sure you typed it in the right way: /path/to/file/file_name")
 
-def list_users():
-    """Print out a list of the existing users."""
-    if os.path.isfile('{}/passes.txt'.format(DATA)):
-        with open('{}/passes.txt'.format(DATA), 'rb') as file:
-            d_pass = pickle.load(file)
-        for user in d_pass:
-            print(user)
+    def __init__(self, file):
+        self._lines = (line.rstrip("\n") for line in file)
+        self._next = None
 
-def get_users():
-    """Return a list of the existing users."""
-    users = []
-    if os.path.isfile('{}/passes.txt'.format(DATA)):
-        with open('{}/passes.txt'.format(DATA), 'rb') as file:
-            d_pass = pickle.load(file)
-        for user in d_pass:
-            users.append(user)
-    return users
-
-def login(user):
-    """Login as a specific user.
+    def _read(self):
+        line, self._next = self._next, None
+        return next(self._lines, None) if line is None else line
 
-    Args:
-        user: Name of the user to be logged in as.
+    def commands(self):
+        """Yield the command lines, skipping the answers that were not asked for."""
+        while True:
+            line = self._read()
+            if line is None:
+                return
+            if not line.startswith(ANSWER_PREFIX):
+                yield line
 
-    Raises:
-        Error if password is not valid.
-    """
-    is_logged_in = False
-    stop = False
-    if not user_exists(user):
-        print("The user {} does not exist. Do you want to create it?".format(user))
-        answer = input("[y/n]: ")
-        if answer == "y":
-            create_user(user)
-            print("Logging in as user " + user)
-        else:
-            stop = True
-    if not stop:
-        if not check_ticket(user):
-            password = getpass.getpass('Password: ')
-            with open('{}/passes.txt'.format(DATA), 'rb') as file:
-                d_pass = pickle.load(file)
-            real_password = d_pass[user][0]
-            salt = d_pass[user][1]
-            hashed_password = binascii.hexlify(hashlib.pbkdf2_hmac('sha256', str.encode(password), salt, 100000))
-            if hashed_password == real_password:
-                print(user + " logged in.")
-                print_new_messages(user)
-                update_ticket(user)
-                is_logged_in = True
-            else:
-                print("Invalid Password")
-        else:
-            is_logged_in = True
-            print(user + " logged in.")
-            print_new_messages(user)
-    return is_logged_in
+    def __iter__(self):
+        return self
 
-def logout(user):
-    """Logout specific user.
+    def __next__(self):
+        """Return the answer on the next line. StopIteration is raised if it is not an answer line."""
+        line = self._read()
+        if line is None or not line.startswith(ANSWER_PREFIX):
+            self._next = line
+            raise StopIteration
+        answer = line[len(ANSWER_PREFIX):]
+        return answer[1:] if answer.startswith(" ") else answer
 
-    Args:
-        user: Name of the user to be logged out.
-    """
-    if user_exists(user):
-        with open(DATA + '/.tickets.txt', 'rb') as file:
-            d_time = pickle.load(file)
-        d_time.pop(user, None)
-        with open(DATA + '/.tickets.txt', 'wb') as file:
-            pickle.dump(d_time, file)
+def run_batch(session, file, checkpoint=0):
+    """Run the commands of a script without prompts and print a JSON result line per command.
 
-def update_ticket(user):
-    """Update ticket of the user after login.
+    The store stays loaded for the whole run and changes are written at the end, or every
+    <checkpoint> commands. Answers to questions (passwords, [y/n]) are read from the answer lines
+    following the command, see Script.
+
+    A command raising an error may have made only part of its changes, so the run stops there and
+    all changes since the last checkpoint are dropped. The result of the command lists the
+    numbers of the first and last dropped command as "rolled_back".
 
     Args:
-        user: Name of the user whose ticket is to be updated.
+        session: Session in which the commands are run.
+        file: Open file to read the commands from.
+        checkpoint: Number of commands after which the changes are written, 0 for the end only.
     """
+    global ANSWERS
+    script = Script(file)
+    lines = script.commands()
+    ANSWERS = script
+    number = 0
+    running = True
     try:
-        with open(DATA + '/.tickets.txt', 'rb') as file:
-            d_time = pickle.load(file)
-    except FileNotFoundError:
-        d_time = {}
-    d_time[user] = time.time()
-    with open(DATA + '/.tickets.txt', 'wb') as file:
-        pickle.dump(d_time, file)
+        while running:
+            first = number + 1
+            with STORE.batch():
+                for command in lines:
+                    number += 1
+                    output = io.StringIO()
+                    error = None
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(output):
+                        try:
+                            running = run_command(session, command.strip())
+                        except Exception as err:  # pylint: disable=broad-except
+                            error = "{}: {}".format(type(err).__name__, err)
+                    result = {"line": number, "command": command.strip(), "user": session.user,
+                              "output": output.getvalue(), "error": error,
+                              "seconds": round(time.perf_counter() - start, 6)}
+                    if error is not None:
+                        STORE.rollback()
+                        result["rolled_back"] = [first, number]
+                        running = False
+                    print(json.dumps(result))
+                    if not running or (checkpoint and number % checkpoint == 0):
+                        break
+                else:
+                    running = False
+    finally:
+        ANSWERS = None
 
-def check_ticket(user):
-    """Check if the current ticket is still valid (less than 30 minutes old).
+USAGE = "Type 'help' for more information about the usage."
 
-    Args:
-        user: Name of the user whose ticket is to be checked.
+class Command:
+    """A command of the command line.
 
-    Returns:
-        True if ticket is still valid, False otherwise.
+    Attributes:
+        name: Name of the command, e.g. 'create user'. Aliases share the name of the command.
+        handler: Function called with the session, the words following the keywords and the whole
+            line. It returns False if the program is to quit.
+        args: True if the command requires arguments, False if it takes none, None if it takes both.
     """
-    ticket = False
-    try:
-        with open(DATA + '/.tickets.txt', 'rb') as file:
-            d_time = pickle.load(file)
-        if user in d_time:
-            delta = (time.time() - d_time[user])/60
-            if delta < 30:
-                ticket = True
-    except FileNotFoundError:
-        ticket = False
-    return ticket
 
-def user_exists(user):
-    """Check if the specified user exists.
+    __slots__ = ("name", "handler", "args")
 
-    Args:
-        user: Name of the user whose existence is to be checked.
+    def __init__(self, name, handler, args=None):
+        self.name = name
+        self.handler = handler
+        self.args = args
 
-    Returns:
-        True if user exists, False otherwise.
+class CommandParser:
+    """Grammar of the command line: a trie of the keywords of the commands.
+
+    A line is parsed by following its words down the trie as long as they are keywords, so the
+    cost does not depend on the number of commands. Forms like 'send to <recipient>: <message>' are
+    matched with precompiled regular expressions by their handlers.
     """
-    res = False
+
+    EXPRESSION = "<expression>"
+    """Keyword of the command handling the lines starting like an expression, e.g. 1+2*3 or (1-2)/3."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, keywords, handler, args=None, name=None):
+        """Register a command.
+
+        Args:
+            keywords: Keywords the command starts with, in lower case.
+            handler: Function handling the command, see Command.
+            args: True if the command requires arguments, False if it takes none, None for both.
+            name: Name of the command, the keywords if None.
+        """
+        node = self._root
+        for keyword in keywords:
+            node = node.setdefault(keyword, {})
+        node[None] = Command(name or " ".join(keywords), handler, args)
+
+    def command(self, *keywords, args=None, name=None):
+        """Decorator registering a function as the handler of a command, see add."""
+        def register(handler):
+            self.add(keywords, handler, args, name)
+            return handler
+        return register
+
+    def parse(self, line):
+        """Split a line into its command, the keywords that were matched and the remaining words.
+
+        Args:
+            line: Stripped line of input.
+
+        Returns:
+            (command, keywords, args). The command is None if the keywords do not lead to one. If
+            no keyword matched at all, keywords is empty.
+        """
+        words = line.split()
+        if not words:
+            return None, [], []
+        first = self.EXPRESSION if words[0][0].isdigit() or words[0][0] in "(+-." else words[0].lower()
+        node = self._root.get(first)
+        if node is None:
+            return None, [], words
+        depth = 1
+        while depth < len(words):
+            child = node.get(words[depth].lower())
+            if child is None:
+                break
+            node = child
+            depth += 1
+        return node.get(None), words[:depth], words[depth:]
+
+PARSER = CommandParser()
+SEND_FORM = re.compile(r"send\s+to\s+(?:(group)\s+)?([^\s:]+)[^:]*:(.*)", re.I | re.S)
+ADD_MEMBERS_FORM = re.compile(r"add\s+members\s+to\s+([^\s:]+)[^:]*:(.*)", re.I | re.S)
+DELETE_MEMBER_FORM = re.compile(r"delete\s+member\s+from\s+([^\s:]+)[^:]*:(.*)", re.I | re.S)
+
+def requires_login(handler):
+    """Decorator of command handlers refusing to run them if no user is logged in."""
+    @functools.wraps(handler)
+    def wrapper(session, args, line):
+        if not user_exists(session.user):
+            print("You need to be logged in to do this.")
+            return True
+        return handler(session, args, line)
+    return wrapper
+
+for word in QUITS:
+    PARSER.add([word], lambda session, args, line: False, args=False, name="quit")
+for word in GREETS:
+    PARSER.add([word], lambda session, args, line: say_hello(session.user), args=False, name="hello")
+
+@PARSER.command(CommandParser.EXPRESSION, name="calc")
+def do_calc(session, args, line):
+    """Print the result of an expression."""
+    std_input(line)
+
+@PARSER.command("help", args=False)
+def do_help(session, args, line):
+    """Print the usage."""
+    print(__doc__)
+
+@PARSER.command("logout", args=False)
+def do_logout(session, args, line):
+    """Log the user of the session out."""
+    logout(session.user, session)
+    session.user = ""
+
+@PARSER.command("sync", args=False)
+@requires_login
+def do_sync(session, args, line):
+    """Print the messages received since the last sync."""
+    print_new_messages(session.user)
+
+@PARSER.command("compact", args=False)
+@requires_login
+def do_compact(session, args, line):
+    """Archive the old read messages of the logged in user."""
+    compact_mailbox(session.user)
+
+@PARSER.command("stats", args=False)
+def do_stats(session, args, line):
+    """Print the counters and timings of this process."""
+    print(STATS.report(), end="")
+
+@PARSER.command("say", args=True)
+def do_say(session, args, line):
+    """Print the arguments."""
+    print("".join(word + " " for word in args))
+
+@PARSER.command("print", args=True)
+def do_print(session, args, line):
+    """Print a file, optionally only its first or last lines or a page at a time."""
+    if session.remote:
+        print("print: Files cannot be printed over the server.")
+        return
     try:
-        with open('{}/{}.txt'.format(DATA, user), 'rb') as file:
-            _ = pickle.load(file)
-        res = True
-    except FileNotFoundError:
-        res = False
-    return res
+        file_name, options = file_options(args)
+    except (getopt.GetoptError, ValueError) as error:
+        print("print: {}. {}".format(error, USAGE))
+    else:
+        print_file(file_name, **options)
 
-def send_message(sender, recipient, msg):
-    """Send message to specified user or group.
+@PARSER.command("print", "messages")
+def do_print_messages(session, args, line):
+    """Print the messages of the logged in user matching the options."""
+    try:
+        print_messages(session.user, **message_filters(args))
+    except (getopt.GetoptError, ValueError) as error:
+        print("print: {}. {}".format(error, USAGE))
 
-    Args:
-        sender: Name of the user who sends the message.
-        recipient: Name of the recipient (user or group).
-        msg: Content of the message.
+@PARSER.command("print", "users", args=False)
+def do_print_users(session, args, line):
+    """Print all users."""
+    list_users()
 
-    Raises:
-        Error if sender or recipient do not exist.
-    """
-    if user_exists(sender) and user_exists(recipient):
-        user_file = '{}/{}.txt'.format(DATA, recipient)
-        with open(user_file, 'rb') as file:
-            d_user = pickle.load(file)
-        d_user["messages"].append(["From {}: {}".format(sender, msg), 1])
-        with open(user_file, 'wb') as file:
-            pickle.dump(d_user, file)
-    elif group_exists(recipient):
-        members = get_group_members(recipient)
-        msg += " (sent to {})".format(recipient)
-        for member in members:
-            send_message(sender, member, msg)
+@PARSER.command("print", "groups", args=False)
+def do_print_groups(session, args, line):
+    """Print all groups."""
+    list_groups()
+
+@PARSER.command("print", "groups", "of", args=True)
+def do_print_groups_of(session, args, line):
+    """Print the groups of a user."""
+    list_groups_of_member(args[0])
+
+@PARSER.command("print", "members", "of", args=True)
+def do_print_members_of(session, args, line):
+    """Print the members of a group."""
+    list_group_members(args[0])
+
+@PARSER.command("search", args=True)
+@requires_login
+def do_search(session, args, line):
+    """Print the messages of the logged in user containing all terms."""
+    search_messages(session.user, line.split(None, 1)[1])
+
+@PARSER.command("login", args=True)
+def do_login(session, args, line):
+    """Log a user in."""
+    if login(args[0], session):
+        session.user = args[0]
+
+@PARSER.command("create", "user")
+def do_create_user(session, args, line):
+    """Create a user."""
+    if not args:
+        print("create: No user name provided. {}".format(USAGE))
     else:
-        print("Recipient or sender does not exist.")
+        create_user(args[0])
 
-def print_messages(user):
-    """Print the messages of the specified user.
+@PARSER.command("create", "group")
+def do_create_group(session, args, line):
+    """Create a group, optionally with members."""
+    if not args:
+        print("create: No group name provided. {}".format(USAGE))
+    else:
+        create_group(args[0], args[1:])
 
-    Args:
-        user: Name of the user whose messages are to be printed.
+@PARSER.command("delete", "user")
+def do_delete_user(session, args, line):
+    """Delete a user."""
+    if not args:
+        print("delete: No user name provided. {}".format(USAGE))
+    else:
+        delete_user(args[0])
 
-    Raises:
-        Error if user does not exist.
-    """
-    if user_exists(user):
-        with open('{}/{}.txt'.format(DATA, user), 'rb') as file:
-            d_user = pickle.load(file)
-        if "messages" in d_user:
-            for msg, _ in d_user["messages"]:
-                print(msg)
-        else:
-            print("No messages.")
+@PARSER.command("delete", "group")
+def do_delete_group(session, args, line):
+    """Delete a group."""
+    if not args:
+        print("delete: No group name provided. {}".format(USAGE))
     else:
-        print("User {} does not exist.".format(user))
+        delete_group(args[0], session.user)
 
-def print_new_messages(user):
-    """Print newly received messages since last login.
+@PARSER.command("delete", "member")
+@requires_login
+def do_delete_member(session, args, line):
+    """Delete a member from a group: delete member from <group>: <member>."""
+    match = DELETE_MEMBER_FORM.fullmatch(line)
+    if match is None:
+        print("delete: Missing data. {}".format(USAGE))
+    else:
+        delete_member_from_group(match.group(2).strip(), match.group(1))
 
-    Args:
-        user: Name of the user whose messages are to be printed.
-    """
-    count = 0
-    with open('{}/{}.txt'.format(DATA, user), 'rb') as file:
-        d_user = pickle.load(file)
-    if "messages" in d_user:
-        for msg, number in d_user["messages"]:
-            if number == 1:
-                count += 1
-                print(msg)
-        d_user["messages"] = [[msg, no] if no == 0 else [msg, 0]  for msg, no in d_user["messages"]]
-        with open('{}/{}.txt'.format(DATA, user), 'wb') as file:
-            pickle.dump(d_user, file)
-    if count == 0:
-        print("No new messages.")
+@PARSER.command("send", args=True)
+def do_send(session, args, line):
+    """Send a message: send to [group] <recipient>: <message>. The message may contain colons."""
+    match = SEND_FORM.fullmatch(line)
+    if ":" not in line:
+        print("send: Missing data. {}".format(USAGE))
+    elif match is None or not match.group(3):
+        print("send: No recipient or message provided. {}".format(USAGE))
+    else:
+        to_group, recipient, msg = match.groups()
+        send_message(session.user, recipient, msg[1:] if msg[0] == " " else msg, to_group=bool(to_group))
 
-def rm_file(file_name):
-    """Check if file exists and if so remove it.
+@PARSER.command("add", "members")
+def do_add_members(session, args, line):
+    """Add members to a group: add members to <group>: <member1>,... or separated by spaces."""
+    match = ADD_MEMBERS_FORM.fullmatch(line)
+    if match is None:
+        print("add: Missing data. {}".format(USAGE))
+    else:
+        add_members_to_group(re.findall(r"[^\s,]+", match.group(2)), match.group(1))
+
+@PARSER.command("import", "users")
+def do_import_users(session, args, line):
+    """Import users from a file."""
+    if session.remote:
+        print("import: Users cannot be imported over the server.")
+    elif len(args) != 1:
+        print("users: Parameter not found. {}".format(USAGE))
+    else:
+        import_users(args[0])
+
+def run_command(session, command):
+    """Process one line of input and call the corresponding command handler, timing it in STATS.
 
     Args:
-        file_name: Path and name of the file to be deleted.
+        session: Session in which the command is run.
+        command: Line of input.
+
+    Returns:
+        False if the command quits the program, True otherwise.
     """
-    if os.path.isfile(file_name):
-        os.remove(file_name)
+    line = command.strip()
+    if not line:
+        return True
+    cmd, keywords, args = PARSER.parse(line)
+    with STATS.timing("command", "unknown" if cmd is None else cmd.name):
+        if cmd is not None:
+            if cmd.args is False and args:
+                print("{}: Command needs to be called without any arguments. {}".format(
+                    " ".join(keywords).lower(), USAGE))
+            elif cmd.args and not args:
+                print("{}: Command requires argument(s). {}".format(" ".join(keywords).lower(), USAGE))
+            else:
+                return cmd.handler(session, args, line) is not False
+        elif not keywords:
+            print("{}: Command not found. {}".format(line.lower(), USAGE))
+        elif args:
+            print("{}: Parameter not found. {}".format(args[0].lower(), USAGE))
+        else:
+            print("{}: Command requires argument(s). {}".format(" ".join(keywords).lower(), USAGE))
+    return True
 
 def main():
     """Set up command line interface and process input to call the corresponding functions."""
-    if not os.path.isdir(DATA):
-        os.mkdir(DATA)
-    if len(sys.argv) == 1:
+    global STORE, HASH_ITERATIONS, MAX_MESSAGES, MAX_AGE, ARCHIVE_CODEC, TICKET_TTL
+    if len(sys.argv) == 1 and sys.stdin.isatty():
         print("Welcome to the messenger. Type 'quit' to exit and 'help' for more information about the usage.")
     try:
-        opts = getopt.getopt(sys.argv[1:], "h", ["help"])[0]
+        opts, args = getopt.getopt(sys.argv[1:], "hb:f:", ["help", "backend=", "migrate", "file=", "checkpoint=",
+                                                           "hash-iterations=", "serve=", "connect=",
+                                                           "max-messages=", "max-age=", "archive-codec=",
+                                                           "ticket-ttl=", "codec=", "convert", "compact",
+                                                           "reindex", "profile=", "calc=", "watch"])
     except getopt.GetoptError as err:
         print(__doc__)
         sys.exit(err)
-    for opt, _ in opts:
+    batch = None if sys.stdin.isatty() else sys.stdin
+    checkpoint = 0
+    serve = None
+    watch = False
+    compact = False
+    reindex = False
+    convert = False
+    migrate = False
+    codec = None
+    for opt, arg in opts:
         if opt in ["-h", "--help"]:
             sys.exit(__doc__)
+        elif opt in ["-f", "--file"]:
+            try:
+                batch = sys.stdin if arg == "-" else open(arg)
+            except FileNotFoundError:
+                sys.exit("{}: File was not found.".format(arg))
+        elif opt == "--checkpoint":
+            if not arg.isdigit():
+                sys.exit("{}: The checkpoint must be a number of commands.".format(arg))
+            checkpoint = int(arg)
+        elif opt == "--hash-iterations":
+            if not arg.isdigit() or int(arg) < 1:
+                sys.exit("{}: The number of iterations must be a positive number.".format(arg))
+            HASH_ITERATIONS = int(arg)
+        elif opt == "--max-messages":
+            if not arg.isdigit():
+                sys.exit("{}: The maximum must be a number of messages.".format(arg))
+            MAX_MESSAGES = int(arg)
+        elif opt == "--max-age":
+            try:
+                MAX_AGE = parse_age(arg)
+            except ValueError:
+                sys.exit("{}: The age must be a number with s, m, h or d, e.g. 90d.".format(arg))
+        elif opt == "--archive-codec":
+            if arg not in ARCHIVE_CODECS:
+                sys.exit("{}: Unknown codec. Choose 'lzma' or 'zlib'.".format(arg))
+            ARCHIVE_CODEC = arg
+        elif opt == "--ticket-ttl":
+            try:
+                TICKET_TTL = parse_age(arg)
+            except ValueError:
+                sys.exit("{}: The time must be a number with s, m, h or d, e.g. 30m.".format(arg))
+        elif opt == "--codec":
+            if arg not in CODECS:
+                sys.exit("{}: Unknown codec. Choose 'pickle', 'json' or 'binary'.".format(arg))
+            codec = arg
+        elif opt == "--convert":
+            convert = True
+        elif opt == "--compact":
+            compact = True
+        elif opt == "--reindex":
+            reindex = True
+        elif opt == "--profile":
+            start_profile(arg)
+        elif opt == "--calc":
+            calc_file(arg)
+            sys.exit()
+        elif opt == "--serve":
+            serve = parse_address(arg)
+        elif opt == "--watch":
+            watch = True
+        elif opt == "--connect":
+            run_client(parse_address(arg))
+            sys.exit()
+        elif opt in ["-b", "--backend"]:
+            if arg not in ["pickle", "sqlite"]:
+                sys.exit("{}: Unknown backend. Choose 'pickle' or 'sqlite'.".format(arg))
+            STORE = open_store(arg)
+        elif opt == "--migrate":
+            migrate = True
 
-    script = sys.argv[0].split("/").pop()[:-3]
-    user = ""
-    quits = ["stop", "quit", "cancel", "q", "end", ":q", "exit"]
-    greets = ["hello", "hi", "greet", "greetings"]
-    cmd_needs_arg = ["login", "say", "print", "create", "delete", "send", "add"]
-    cmd_no_args = ["help", "logout", "sync"]
-    cmd_no_args.extend(greets)
-    cmd_no_args.extend(quits)
-    if len(sys.argv) == 2:
-        user = sys.argv[1]
-        login(user)
-    if user != "":
-        prompt = "{}:{}# ".format(user, script)
-    else:
-        prompt = script + "# "
+    choose_codec(codec, convert)
+    if migrate:
+        if not os.path.isdir(DATA):
+            sys.exit("There is no data directory to migrate.")
+        migrate_to_sqlite()
+        sys.exit()
 
-    while True:
-        command = input(prompt)
-        if not command:
+    if convert or compact or reindex:
+        if not os.path.isdir(DATA):
+            sys.exit("There is no data directory.")
+        if convert:
+            convert_data()
+        if compact:
+            compact_mailboxes()
+        if reindex:
+            STORE.rebuild_index()
+            print("Rebuilt the search index.")
+        STORE.close()
+        sys.exit()
+    if not os.path.isdir(DATA):
+        os.mkdir(DATA)
+    if not os.path.exists(DATA + "/" + CODEC_FILE):
+        store_codec()
+    hash_pool()
+    session = Session(sys.argv[0].split("/").pop()[:-3])
+    if serve is not None:
+        try:
+            asyncio.run(Server(session.script).serve(serve))
+        except KeyboardInterrupt:
             pass
-        elif command.lower() in quits:
-            if not get_users():
-                rm_file(DATA + "/groups.txt")
-                rm_file(DATA + "/passes.txt")
-                rm_file(DATA + "/.tickets.txt")
-                os.rmdir(DATA)
-            break
-        elif command[0].isdigit():
-            std_input(command)
-        elif command.lower() in greets:
-            say_hello(user)
-        elif command.lower() == "help":
-            print(__doc__)
-        elif command.lower() == "logout":
-            logout(user)
-            user = ""
-            prompt = script + "# "
-        elif command.lower() == "sync":
-            if user_exists(user):
-                print_new_messages(user)
-            else:
-                print("You need to be logged in to do this.")
-        elif len(command.split()) > 1:
-            inp = command.split()
-            if inp[0].lower() == "say":
-                for i in inp[1:]:
-                    print(i + " ", end='')
-                print("")
-            elif inp[0].lower() == "print":
-                if inp[1].lower() == "messages":
-                    print_messages(user)
-                elif inp[1].lower() == "users":
-                    list_users()
-                elif inp[1].lower() == "groups" and len(inp) == 2:
-                    list_groups()
-                elif inp[1].lower() == "groups" and len(inp) > 2:
-                    list_groups_of_member(inp[3])
-                elif inp[1].lower() == "members":
-                    list_group_members(inp[3])
-                else:
-                    print_file(inp[1])
-            elif inp[0].lower() == "login":
-                if login(inp[1]):
-                    user = inp[1]
-                    prompt = "{}:{}# ".format(user, script)
-            elif inp[0].lower() == "create":
-                if inp[1].lower() == "user":
-                    try:
-                        create_user(inp[2])
-                    except IndexError:
-                        print("{}: No user name provided. Type 'help' for more information about the usage.".format(
-                            inp[0].lower()))
-                elif inp[1].lower() == "group":
-                    try:
-                        create_group(inp[2], inp[3:])
-                    except IndexError:
-                        print("{}: No group name provided. Type 'help' for more information about the usage.".format(
-                            inp[0].lower()))
-                else:
-                    print("{}: Parameter not found. Type 'help' for more information about the usage.".format(
-                        inp[1].lower()))
-            elif inp[0].lower() == "delete":
-                if inp[1].lower() == "user":
-                    try:
-                        delete_user(inp[2])
-                    except IndexError:
-                        print("{}: No user name provided. Type 'help' for more information about the usage.".format(
-                            inp[0].lower()))
-                elif inp[1].lower() == "group":
-                    try:
-                        delete_group(inp[2], user)
-                    except IndexError:
-                        print("{}: No group name provided. Type 'help' for more information about the usage.".format(
-                            inp[0].lower()))
-                elif inp[1].lower() == "member":
-                    if user_exists(user):
-                        try:
-                            meta, memb = command.split(":")
-                            grp = meta.split()[3]
-                            delete_member_from_group(memb.strip(), grp)
-                        except ValueError:
-                            print("{}: Missing data. Type 'help' for more information about the usage.".format(
-                                inp[0].lower()))
-                    else:
-                        print("You need to be logged in to do this.")
-                else:
-                    print("{}: Parameter not found. Type 'help' for more information about the usage.".format(
-                        inp[1].lower()))
-            elif inp[0].lower() == "send":
-                try:
-                    meta, msg = command.split(":")
-                    if not msg or len(meta.split()) < 3:
-                        print("{}: No recipient or message provided. Type 'help' for more information about the usage."
-                              .format(inp[0].lower()))
-                    else:
-                        if msg[0] == " ":
-                            msg = msg[1:]
-                        recipient = meta.split()[2]
-                        send_message(user, recipient, msg)
-                except ValueError:
-                    print("{}: Missing data. Type 'help' for more information about the usage.".format(
-                        inp[0].lower()))
-            elif inp[0].lower() == "add":
-                if inp[1] == "members":
-                    try:
-                        meta, memb = command.split(":")
-                        grp = meta.split()[3]
-                        add_members_to_group(memb.split(), grp)
-                    except ValueError:
-                        print("{}: Missing data. Type 'help' for more information about the usage.".format(
-                            inp[0].lower()))
-                else:
-                    print("{}: Parameter not found. Type 'help' for more information about the usage.".format(
-                        inp[1].lower()))
-            elif inp[0].lower() in cmd_no_args:
-                print("{}: Command needs to be called without any arguments.".format(inp[0].lower()), end=" ")
-                print("Type 'help' for more information about the usage.")
-            else:
-                print("{}: Command not found. Type 'help' for more information about the usage.".format(
-                    command.lower()))
-        elif command.lower() in cmd_needs_arg:
-            print("{}: Command requires argument(s). Type 'help' for more information about the usage.".format(
-                command.lower()))
-        else:
-            print("{}: Command not found. Type 'help' for more information about the usage.".format(command.lower()))
+        return
+    if len(args) == 1 and login(args[0]):
+        session.user = args[0]
+    if batch is not None:
+        run_batch(session, batch, checkpoint)
+    else:
+        watcher = Watcher(session) if watch else None
+        while True:
+            try:
+                command = input(session.prompt)
+            except EOFError:
+                command = "quit"
+            with watcher.running() if watcher is not None else contextlib.nullcontext():
+                running = run_command(session, command)
+            if not running:
+                break
+        if watcher is not None:
+            watcher.stop()
+    clean_up()
 
 if __name__ == '__main__':
     main()